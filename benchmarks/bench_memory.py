@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import argparse
+import gc
+import tracemalloc
+
+from magloader.assembly import Assembly
+from magloader.manifest import Manifest
+from magloader.submission import SubmissionResponseObject
+
+
+def get_objects(n_samples):
+    # what a study keeps alive per sample: assembly, sample, receipt object and manifest
+    objects = []
+    for i in range(n_samples):
+        assembly = Assembly(
+            spire_ena_project_id="PRJEB00000",
+            sample_id=i,
+            program="megahit",
+            program_version="1.2.9",
+            file_path=f"/data/assemblies/sample_{i}-assembled.fa.gz",
+            coverage=10.0,
+            biosamples=f"SAMEA{i:09d}",
+        )
+        biosample = SubmissionResponseObject(
+            alias=f"spire_sample_{i}",
+            object_type="sample",
+            accession=f"ERS{i:08d}",
+            ext_accession=f"SAMEA{i:09d}",
+            status="PRIVATE",
+            hold_until="2025-12-31Z",
+        )
+        objects.append((assembly, assembly.get_sample(), biosample, Manifest.from_assembly(assembly, "PRJEB00000", biosample.accession),))
+    return objects
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n_samples", type=int, default=100_000,)
+    args = ap.parse_args()
+
+    gc.collect()
+    tracemalloc.start()
+    objects = get_objects(args.n_samples)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{len(objects)} samples: {current / 2**20:.1f} MiB ({current / len(objects):.0f} bytes/sample), peak {peak / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
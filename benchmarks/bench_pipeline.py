@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+""" Times the stages of a magloader run against a local drop-box stand-in and a fake webin-cli.
+
+Usage (with magloader installed): python benchmarks/bench_pipeline.py --n_assemblies 10 1000 50000 --threads 1 4 16
+"""
+
+import argparse
+import contextlib
+import json
+import pathlib
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+from functools import partial
+
+from magloader.pipeline import register_object
+from magloader.assembly import Assembly
+from magloader.preflight import preflight
+from magloader.sample import SampleSet
+from magloader.study import STUDY_TYPES
+from magloader.submission import get_session, Submission, SubmissionResponse
+from magloader.upload import check_assemblies, prepare_manifest_files, process_manifest, upload
+from magloader.webin import JVM_OPTS
+
+from fake_services import FakeDropBox, write_fake_webin_cli, write_fasta, write_study_json
+
+
+@contextlib.contextmanager
+def timed(timings, stage, n_items=None,):
+    t0 = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - t0
+    timings.append((stage, n_items, elapsed))
+    rate = f"\t{n_items / elapsed:.1f} items/s" if n_items and elapsed else ""
+    print(f"{stage:<40}{elapsed:10.3f}s{rate}")
+
+
+def run_pipeline(n_assemblies, threads, workdir, dropbox, webin_cli, webin_cli_server=None,):
+    timings = []
+    user, pw = "Webin-0", "benchmark"
+    session = get_session()
+
+    study_json = write_study_json(workdir / "study.json", n_assemblies, write_fasta(workdir / "assembly.fa.gz"))
+    with timed(timings, "load study json", n_assemblies):
+        with open(study_json, "rt", encoding="UTF-8",) as json_in:
+            study_data = json.load(json_in)
+
+    study_dir = workdir / "study"
+    study_dir.mkdir()
+    study_obj = STUDY_TYPES["ena"](study_id=study_data["study_id"], raw_data_projects=study_data["accessions"],)
+    with timed(timings, "study registration"):
+        studies = list(register_object(user, pw, study_obj, "study", outdir=study_dir, session=session, dropbox_url=dropbox.url,))
+    study_id = studies[0].accession
+
+    assemblies = {
+        f"spire_sample_{assembly['sample_id']}": Assembly(**assembly, spire_ena_project_id=study_id)
+        for assembly in study_data["assemblies"]
+    }
+    sample_set = SampleSet()
+    sample_set.samples += (assembly.get_sample() for assembly in assemblies.values())
+
+    with timed(timings, "SampleSet.toxml", n_assemblies):
+        sample_set.toxml()
+
+    sample_dir = workdir / "samples"
+    sample_dir.mkdir()
+    with timed(timings, "Submission.submit (samples)", n_assemblies):
+        biosamples = Submission(user, pw, session=session, url=dropbox.url,).submit(sample_set, outdir=sample_dir,).objects
+
+    with open(sample_dir / "sampleset_ena_response.xml", "rt") as _in:
+        response_xml = _in.read()
+    with timed(timings, "SubmissionResponse.from_xml", n_assemblies):
+        SubmissionResponse.from_xml(response_xml, SampleSet)
+
+    with timed(timings, "prepare_manifest_files", n_assemblies):
+        manifests = list(prepare_manifest_files(study_id, check_assemblies(biosamples, assemblies), workdir,))
+
+    for n_threads in threads:
+        with timed(timings, f"preflight (threads={n_threads})", n_assemblies):
+            list(preflight(manifests, threads=n_threads,))
+
+    process_manifest_partial = partial(process_manifest, user=user, password=pw, webin_cli=str(webin_cli), webin_cli_server=webin_cli_server,)
+    for n_threads in threads:
+        for manifest in manifests:
+            for sentinel in ("DONE", "VALIDATION_DONE",):
+                try:
+                    (manifest.parent / sentinel).unlink()
+                except FileNotFoundError:
+                    pass
+        with timed(timings, f"upload (threads={n_threads}{', persistent' if webin_cli_server else ''})", n_assemblies):
+            for _ in upload(manifests, process_manifest_partial, threads=n_threads,):
+                ...
+
+    return timings
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n_assemblies", type=int, nargs="+", default=[10, 1000],)
+    ap.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16],)
+    ap.add_argument("--webin_latency", type=float, default=0.0,)  # seconds per fake webin-cli call
+    ap.add_argument("--persistent", action="store_true",)  # run the fake webin-cli as one persistent server per worker
+    ap.add_argument("--dropbox_latency", type=float, default=0.0,)  # seconds per fake drop-box request
+    ap.add_argument("--output", type=str, default=None,)  # write timings as json
+    args = ap.parse_args()
+
+    results = {}
+    with FakeDropBox(latency=args.dropbox_latency) as dropbox:
+        for n_assemblies in args.n_assemblies:
+            print(f"--- {n_assemblies} assemblies ---")
+            workdir = pathlib.Path(tempfile.mkdtemp(prefix="magloader_bench_"))
+            try:
+                webin_cli = write_fake_webin_cli(workdir / "fake-webin-cli", latency=args.webin_latency,)
+                webin_cli_server = (
+                    f"{shlex.quote(sys.executable)} -m magloader.fake_webin {JVM_OPTS} --server --latency {args.webin_latency}"
+                    if args.persistent else None
+                )
+                results[n_assemblies] = run_pipeline(n_assemblies, args.threads, workdir, dropbox, webin_cli, webin_cli_server=webin_cli_server,)
+            finally:
+                shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "wt") as _out:
+            json.dump(results, _out, indent=4,)
+
+
+if __name__ == "__main__":
+    main()
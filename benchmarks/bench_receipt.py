@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+import tracemalloc
+
+from magloader.sample import SampleSet
+from magloader.submission import SubmissionResponse
+
+
+def get_receipt(n_samples, failed_every):
+    # a drop-box receipt with n_samples SAMPLE entries, every failed_every-th one
+    # rejected with an "already exists" error that has to be recovered from MESSAGES
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<RECEIPT receiptDate="2025-06-05T09:17:27.485+01:00" submissionFile="SUBMISSION" success="false">']
+    errors = []
+    for i in range(n_samples):
+        if failed_every and i % failed_every == 0:
+            lines.append(f'<SAMPLE alias="spire_sample_{i}" status="PRIVATE"/>')
+            errors.append(
+                f'<ERROR>In sample, alias: "spire_sample_{i}". The object being added already exists '
+                f'in the submission account with accession: "ERS{i:08d}".</ERROR>'
+            )
+        else:
+            lines.append(
+                f'<SAMPLE accession="ERS{i:08d}" alias="spire_sample_{i}" status="PRIVATE" holdUntilDate="2025-12-31Z">'
+                f'<EXT_ID accession="SAMEA{i:09d}" type="biosample"/></SAMPLE>'
+            )
+    lines.append('<SUBMISSION accession="ERA00000000" alias="SUBMISSION-05-06-2025-09:17:27:066"/>')
+    lines += ["<MESSAGES>"] + errors + ["<INFO>All objects in this submission are set to private status (HOLD).</INFO>", "</MESSAGES>"]
+    lines += ["<ACTIONS>ADD</ACTIONS>", "<ACTIONS>HOLD</ACTIONS>", "</RECEIPT>"]
+    return "\n".join(lines).encode()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n_samples", type=int, default=50_000,)
+    ap.add_argument("--failed_every", type=int, default=10,)
+    ap.add_argument("--repeats", type=int, default=3,)
+    args = ap.parse_args()
+
+    receipt = get_receipt(args.n_samples, args.failed_every)
+
+    timings = []
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        response = SubmissionResponse.from_xml(receipt, SampleSet)
+        timings.append(time.perf_counter() - t0)
+
+    assert len(response.objects) == args.n_samples, len(response.objects)
+    n_recovered = sum(obj.recovered for obj in response.objects)
+
+    tracemalloc.start()
+    SubmissionResponse.from_xml(receipt, SampleSet)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(timings)
+    print(
+        f"SubmissionResponse.from_xml: {args.n_samples} samples ({n_recovered} recovered, {len(receipt)} bytes) "
+        f"in {best:.3f}s, peak {peak / 2 ** 20:.1f} MiB"
+    )
+
+
+if __name__ == "__main__":
+    main()
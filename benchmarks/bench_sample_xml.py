@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+import lxml.etree
+
+from magloader.sample import Sample, SampleSet
+
+
+def get_samples(n_samples):
+    return [
+        Sample(
+            spire_ena_project_id="PRJEB00000",
+            sample_id=str(i),
+            biosamples=f"SAMEA{i:09d};SAMEA{i + 1:09d};mgp{i}",
+        )
+        for i in range(n_samples)
+    ]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n_samples", type=int, default=100_000,)
+    ap.add_argument("--repeats", type=int, default=3,)
+    args = ap.parse_args()
+
+    samples = get_samples(args.n_samples)
+
+    timings = []
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        for sample in samples:
+            sample.toxml()
+        timings.append(time.perf_counter() - t0)
+
+    best = min(timings)
+    print(f"Sample.toxml: {args.n_samples} samples in {best:.3f}s ({1e6 * best / args.n_samples:.2f} us/sample)")
+
+    sample_set = SampleSet()
+    sample_set.samples += samples
+    t0 = time.perf_counter()
+    n_bytes = len(lxml.etree.tostring(sample_set.toxml()))
+    elapsed = time.perf_counter() - t0
+    print(f"SampleSet.toxml + tostring: {n_bytes} bytes in {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+""" Offline check of the pre-flight manifest checks on manifests written by Manifest.to_str:
+    valid edge cases (COVERAGE 0) pass, broken manifests and FASTA files are reported.
+
+Usage (with magloader installed): python benchmarks/check_preflight.py
+"""
+
+import gzip
+import pathlib
+import sys
+import tempfile
+
+from magloader.manifest import Manifest
+from magloader.preflight import check_manifest
+
+
+FASTA = b">contig_1\nACGTACGTNN\n>contig_2\nACGT\n"
+
+
+def check_manifest_file(workdir, name, expected_errors, fasta=FASTA, **fields,):
+    manifest_dir = workdir / name
+    manifest_dir.mkdir()
+    with gzip.open(manifest_dir / "assembly.fa.gz", "wb") as _out:
+        _out.write(fasta)
+
+    manifest = Manifest(
+        study="PRJEB00000", sample="SAMEA000000001", assemblyname=name,
+        program="megahit", fasta="assembly.fa.gz", coverage=10.0,
+    )
+    for k, v in fields.items():
+        setattr(manifest, k, v)
+    with open(manifest_dir / f"{name}.manifest.txt", "wt", encoding="UTF-8",) as _out:
+        print(manifest.to_str(), file=_out,)
+
+    errors = check_manifest(manifest_dir / f"{name}.manifest.txt").errors
+    ok = len(errors) == expected_errors
+    print(f"{name}: {len(errors)} error(s), expected {expected_errors} -> {'OK' if ok else 'FAIL'}", *errors, sep="\n  ",)
+    return ok
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = pathlib.Path(workdir)
+        ok = all(
+            [
+                check_manifest_file(workdir, "valid", 0,),
+                check_manifest_file(workdir, "zero_coverage", 0, coverage=0.0,),
+                check_manifest_file(workdir, "int_zero_coverage", 0, coverage=0,),
+                check_manifest_file(workdir, "negative_coverage", 1, coverage=-1.0,),
+                check_manifest_file(workdir, "missing_coverage", 1, coverage=None,),
+                check_manifest_file(workdir, "invalid_sequence", 1, fasta=b">contig_1\nACGT-XYZ\n",),
+            ]
+        )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
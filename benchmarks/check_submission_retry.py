@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+""" Offline check of Submission.post's retries against the local drop-box stand-in:
+    5xx responses are retried, and every attempt sends the complete multipart body.
+
+Usage (with magloader installed): python benchmarks/check_submission_retry.py
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+
+import requests
+
+from magloader.sample import Sample, SampleSet
+from magloader.submission import Submission
+
+from fake_services import FakeDropBox
+
+
+def check_retry(n_failures, retries, n_samples=100,):
+    sample_set = SampleSet()
+    sample_set.samples += (
+        Sample(spire_ena_project_id="PRJEB00000", sample_id=i, biosamples=f"SAMEA{i:09d}",)
+        for i in range(n_samples)
+    )
+
+    errors, response = [], None
+    with FakeDropBox(fail_first=n_failures) as dropbox, tempfile.TemporaryDirectory() as outdir:
+        sub = Submission("Webin-0", "pw", url=dropbox.url, retries=retries, backoff=0.0,)
+        try:
+            response = sub.submit(sample_set, outdir=pathlib.Path(outdir),)
+        except requests.RequestException as err:
+            errors.append(f"submission failed: {err}")
+
+    statuses = [status for status, _ in dropbox.requests]
+    expected = [503] * min(n_failures, retries + 1) + [200] * (n_failures <= retries)
+    if statuses != expected:
+        errors.append(f"responses {statuses}, expected {expected}")
+    if len({body for _, body in dropbox.requests}) != 1:
+        errors.append(f"request bodies differ between attempts: {[len(body) for _, body in dropbox.requests]} bytes")
+    if n_failures <= retries and response is not None:
+        if not response.success or len(response.objects) != n_samples:
+            errors.append(f"expected {n_samples} accessioned samples, got {len(response.objects)}")
+    print(f"{n_failures} failure(s), {retries} retries: {statuses} -> {'FAIL' if errors else 'OK'}", *errors, sep="\n  ",)
+    return not errors
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--retries", type=int, default=3,)
+    args = ap.parse_args()
+
+    ok = all(
+        [
+            check_retry(0, args.retries),
+            check_retry(1, args.retries),
+            check_retry(args.retries, args.retries),
+        ]
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import email.parser
+import gzip
+import itertools
+import json
+import pathlib
+import shlex
+import stat
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import lxml.etree
+
+import magloader
+
+
+# launcher for magloader.fake_webin, for use as --webin_cli (webin-cli runs in the manifest directories,
+# the magloader package the launcher was written for is put on the path)
+FAKE_WEBIN_CLI = """#!/bin/sh
+PYTHONPATH={package_root}${{PYTHONPATH:+:$PYTHONPATH}} exec {python} -m magloader.fake_webin --latency {latency} "$@"
+"""
+
+
+def write_fake_webin_cli(path, latency=0.0):
+    path = pathlib.Path(path)
+    with open(path, "wt") as _out:
+        _out.write(
+            FAKE_WEBIN_CLI.format(
+                python=shlex.quote(sys.executable),
+                package_root=shlex.quote(str(pathlib.Path(magloader.__file__).parent.parent)),
+                latency=latency,
+            )
+        )
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return path
+
+
+def write_study_json(path, n_assemblies, fasta):
+    study_data = {
+        "study_id": "1",
+        "study_name": "benchmark",
+        "study_type": "ena",
+        "accessions": "PRJEB00000",
+        "assemblies": [
+            {
+                "sample_id": i,
+                "program": "megahit",
+                "program_version": "1.2.9",
+                "coverage": 10.0,
+                "file_path": str(fasta),
+                "biosamples": f"SAMEA{i:09d}",
+            }
+            for i in range(n_assemblies)
+        ],
+    }
+    with open(path, "wt", encoding="UTF-8",) as json_out:
+        json.dump(study_data, json_out)
+    return path
+
+
+def write_fasta(path, n_contigs=100, contig_length=1000):
+    with gzip.open(path, "wt") as _out:
+        for i in range(n_contigs):
+            print(f">contig_{i}", "ACGT" * (contig_length // 4), sep="\n", file=_out)
+    return path
+
+
+class FakeDropBoxHandler(BaseHTTPRequestHandler):
+    accessions = itertools.count(1)
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            fail = len(self.server.requests) < self.server.fail_first
+            self.server.requests.append((503 if fail else 200, body,))
+        if fail:
+            self.send_error(503, "Service Unavailable")
+            return
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+        )
+
+        receipt = lxml.etree.Element("RECEIPT", receiptDate="2025-06-05T09:17:27.485+01:00", submissionFile="SUBMISSION", success="true",)
+        for part in message.get_payload():
+            if part.get_param("name", header="content-disposition") == "SUBMISSION":
+                continue
+            for obj in lxml.etree.fromstring(part.get_payload(decode=True)).iter("SAMPLE", "STUDY"):
+                i = next(self.accessions)
+                if obj.tag == "SAMPLE":
+                    sample = lxml.etree.SubElement(receipt, "SAMPLE", accession=f"ERS{i:08d}", alias=obj.get("alias"), status="PRIVATE",)
+                    lxml.etree.SubElement(sample, "EXT_ID", accession=f"SAMEA{i:09d}", type="biosample",)
+                else:
+                    study = lxml.etree.SubElement(receipt, "STUDY", accession=f"PRJEB{i:05d}", alias=obj.get("alias"), status="PRIVATE",)
+                    lxml.etree.SubElement(study, "EXT_ID", accession=f"ERP{i:06d}", type="study",)
+        lxml.etree.SubElement(receipt, "SUBMISSION", accession="ERA00000001", alias="SUBMISSION-benchmark",)
+
+        response = lxml.etree.tostring(receipt, xml_declaration=True, encoding="UTF-8",)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        ...
+
+
+class FakeDropBox:
+    # the first fail_first requests are answered with 503, all (status, body) pairs are kept in .requests
+    def __init__(self, latency=0.0, fail_first=0,):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDropBoxHandler)
+        self.server.latency = latency
+        self.server.fail_first = fail_first
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True,)
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/ena/submit/drop-box/submit/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,8 +1,10 @@
 from dataclasses import dataclass
 
 from .sample import Sample
+from .slots import intern, slotted
 
 
+@slotted
 @dataclass
 class Assembly:
     # spire_ena_project_id	sample_id	assembly_name	assembly_type	program	description	file_path
@@ -21,6 +23,10 @@ class Assembly:
             self.program = f"{self.program} v{self.program_version}"
         if not self.assembly_name:
             self.assembly_name = f"spire_assembly_{self.sample_id}"
+        self.spire_ena_project_id = intern(self.spire_ena_project_id)
+        self.assembly_type = intern(self.assembly_type)
+        self.program = intern(self.program)
+        self.program_version = intern(self.program_version)
 
     def get_sample(self):
         print(self)
@@ -0,0 +1,183 @@
+import argparse
+import collections
+import glob
+import hashlib
+import pathlib
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from .pipeline import (
+    add_arguments,
+    get_heap_model,
+    get_process_manifest_partial,
+    get_retry_policy,
+    get_scheduler,
+    get_workdir,
+    prepare_study,
+    record_upload_result,
+    run_preflight,
+    write_previous_accessions,
+)
+from .metrics import get_metrics
+from .state import StateStore
+from .submission import get_session
+from .upload import as_completed_bounded, upload
+from .webin import classify_messages, get_webin_credentials
+
+
+@dataclass
+class BatchStudy:
+    study_json: pathlib.Path = None
+    workdir: pathlib.Path = None
+    state: StateStore = None
+    manifests: list = field(default_factory=list)
+    run_id: int = None
+    n_done: int = 0
+    n_failed: int = 0
+    error: str = None
+
+
+def get_study_jsons(patterns, study_list=None):
+    if study_list:
+        with open(study_list, "rt", encoding="UTF-8",) as _in:
+            patterns = list(patterns) + [line.strip() for line in _in if line.strip()]
+    seen = set()
+    for pattern in patterns:
+        for study_json in sorted(glob.glob(pattern)) or [pattern]:
+            study_json = pathlib.Path(study_json)
+            if study_json.resolve() not in seen:
+                seen.add(study_json.resolve())
+                yield study_json
+
+
+def get_study_workdir_name(study_json):
+    # <stem>_<hash of the absolute path>: inputs with the same file name
+    # in different directories do not share a workdir
+    study_json = pathlib.Path(study_json).resolve()
+    return f"{study_json.stem}_{hashlib.sha1(str(study_json).encode()).hexdigest()[:8]}"
+
+
+def get_study_workdirs(workdir, study_jsons):
+    workdirs = {study_json: workdir / get_study_workdir_name(study_json) for study_json in study_jsons}
+
+    studies_of = collections.defaultdict(list)
+    for study_json, study_workdir in workdirs.items():
+        studies_of[study_workdir].append(study_json)
+    collisions = [studies for studies in studies_of.values() if len(studies) > 1]
+    if collisions:
+        raise ValueError(
+            "Studies would share a workdir: " + "; ".join(", ".join(map(str, studies)) for studies in collisions)
+        )
+
+    return workdirs
+
+
+def interleave(*iterables):
+    # round-robin over the studies, so a large study cannot starve the others
+    iterators = collections.deque(iter(it) for it in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        yield item
+        iterators.append(iterator)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="magloader batch")
+    add_arguments(ap)
+    ap.add_argument("study_jsons", type=str, nargs="*",)  # study json files or glob patterns
+    ap.add_argument("--study_list", type=str, default=None,)  # file with one study json (or pattern) per line
+    ap.add_argument("--study_threads", type=int, default=1,)  # max. studies registered concurrently
+
+    args = ap.parse_args(argv)
+
+    user, pw = get_webin_credentials(args.webin_credentials)
+    session = get_session(pool_size=max(args.study_threads * args.sample_threads, 1))
+
+    workdir = get_workdir(args.workdir, override=args.override,)
+    # one metrics file for the whole batch, records carry the study as label
+    metrics = get_metrics(workdir, prometheus_file=args.prometheus_textfile,)
+    studies = []
+    study_jsons = list(get_study_jsons(args.study_jsons, study_list=args.study_list,))
+    for study_json, study_workdir in get_study_workdirs(workdir, study_jsons).items():
+        study_workdir = get_workdir(study_workdir)
+        studies.append(BatchStudy(study_json=study_json, workdir=study_workdir, state=StateStore(study_workdir),))
+
+    if not studies:
+        raise ValueError("No study json files given.")
+
+    def prepare(study):
+        try:
+            with metrics.timed("stage_seconds", stage="prepare_study", study=study.workdir.name,):
+                study.manifests = prepare_study(study.study_json, study.workdir, args, user, pw, session, study.state, metrics=metrics,)
+        except Exception as err:
+            # a failing study must not abort the whole batch
+            print(f"Preparing {study.study_json} failed.\n\n", err)
+            study.error = str(err)
+        return study
+
+    with ThreadPoolExecutor(max_workers=args.study_threads) as pool:
+        for study in as_completed_bounded(pool, prepare, studies, args.study_threads):
+            print(f"PREPARED {study.study_json}: {len(study.manifests)} manifests{' (' + study.error + ')' if study.error else ''}")
+
+    study_of = {
+        str(pathlib.Path(manifest).absolute()): study
+        for study in studies
+        for manifest in study.manifests
+    }
+
+    n_manifests = sum(len(study.manifests) for study in studies)
+    manifests = run_preflight(
+        interleave(*(study.manifests for study in studies)),
+        args,
+        lambda manifest: study_of[str(pathlib.Path(manifest).absolute())].state,
+        metrics=metrics,
+    )
+
+    metrics.export(force=True)
+
+    process_manifest_partial = get_process_manifest_partial(
+        args, user, pw, metrics=metrics, heap_model=get_heap_model(args, [study.state for study in studies]),
+    )
+
+    accessions = {}
+    for study in studies:
+        study.run_id = study.state.start_run()
+        accessions[study.study_json] = open(study.workdir / "assembly_accessions.txt", "wt")
+        write_previous_accessions(study.state, accessions[study.study_json])
+
+    t0 = time.perf_counter()
+    try:
+        for i, ena_id, messages, manifest in upload(manifests, process_manifest_partial, threads=args.threads, max_pending=args.max_pending, executor=args.executor, metrics=metrics, scheduler=get_scheduler(args), retry_policy=get_retry_policy(args),):
+            study = study_of[str(manifest)]
+            record_upload_result(study.state, ena_id, messages, manifest, accessions[study.study_json])
+            metrics.emit(
+                "assembly_uploaded", time.perf_counter() - t0,
+                status="done" if ena_id is not None else "failed", assembly=manifest.parent.name, study=study.workdir.name,
+            )
+            if ena_id is not None:
+                study.n_done += 1
+            else:
+                study.n_failed += 1
+                print(classify_messages(messages).upper(), *messages, sep="\n",)
+            n_done = sum(study.n_done for study in studies)
+            print(
+                f"[{i}/{n_manifests}] {study.study_json.name}: {ena_id or 'FAILED'} "
+                f"(study: {study.n_done} done, {study.n_failed} failed; total: {n_done} done, {i - n_done} failed)"
+            )
+            print("-----------------------------------------------------")
+            metrics.export()
+    finally:
+        metrics.emit("stage_seconds", time.perf_counter() - t0, stage="upload",)
+        metrics.export(force=True)
+        for study in studies:
+            accessions[study.study_json].close()
+            study.state.finish_run(study.run_id, study.n_done, study.n_failed)
+            study.state.close()
+
+    return None
@@ -0,0 +1,64 @@
+""" Stand-in for webin-cli, for tests and benchmarks without java or ENA access.
+
+    python -m magloader.fake_webin [--latency S] <webin-cli arguments>
+        behaves like one webin-cli run: writes webin-cli.report (into -outputDir or the cwd)
+        with a successful validation or a deterministic ERZ accession for -submit
+    python -m magloader.fake_webin --server [--latency S]
+        speaks the protocol of the persistent webin-cli server (see WebinCliServer.java)
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+import zlib
+
+from .webin import SERVER_EXIT_MARKER, SERVER_ARG_SEP, WEBIN_CLI_REPORT
+
+
+def get_messages(args):
+    manifest = args[args.index("-manifest") + 1]
+    if "-validate" in args:
+        yield "INFO", "Submission(s) validated successfully."
+    else:
+        yield "INFO", (
+            "The submission has been completed successfully. "
+            "The following analysis accession was assigned to the submission: "
+            f"ERZ{zlib.crc32(pathlib.Path(manifest).name.encode()):010d}"
+        )
+
+
+def run_webin_cli(args, latency=0.0):
+    # jvm options (-Xmx...) in front of the webin-cli arguments are ignored
+    time.sleep(latency)
+    output_dir = pathlib.Path(args[args.index("-outputDir") + 1] if "-outputDir" in args else ".")
+    with open(output_dir / WEBIN_CLI_REPORT, "wt", encoding="UTF-8",) as report:
+        for event, message in get_messages(args):
+            # timestamped in the report, level and message only on the console
+            print(f"2025-06-06T12:55:57 {event} : {message}", file=report,)
+            print(f"{event}: {message}", flush=True,)
+    return 0
+
+
+def serve(latency=0.0):
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+        returncode = run_webin_cli(line.split(SERVER_ARG_SEP), latency=latency)
+        print(SERVER_EXIT_MARKER, returncode, flush=True,)
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="python -m magloader.fake_webin")
+    ap.add_argument("--latency", type=float, default=0.0,)  # seconds per webin-cli run
+    ap.add_argument("--server", action="store_true",)
+    args, webin_args = ap.parse_known_args()
+
+    if args.server:
+        return serve(latency=args.latency)
+    return run_webin_cli(webin_args, latency=args.latency)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
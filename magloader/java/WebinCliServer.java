@@ -0,0 +1,60 @@
+/*
+ * Persistent webin-cli: one JVM runs any number of webin-cli invocations, so only the first
+ * manifest per worker pays for JVM startup and class loading.
+ *
+ * Run with the webin-cli jar on the classpath (java 11+ runs the source file directly):
+ *
+ *     java -Xmx4g -cp webin-cli.jar WebinCliServer.java
+ *
+ * Protocol (stdin/stdout, UTF-8): one request per line, the webin-cli arguments separated by tabs.
+ * The output of the run is written to stdout as it is produced, followed by a line
+ * "@@WEBIN-CLI-EXIT@@ <returncode>". The server exits at the end of stdin, and without an exit
+ * line after an OutOfMemoryError, so that the client starts a fresh JVM.
+ */
+
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+
+public class WebinCliServer {
+    public static final String EXIT_MARKER = "@@WEBIN-CLI-EXIT@@";
+    public static final String ARG_SEP = "\t";
+
+    public static void main(String[] args) throws Exception {
+        // webin-cli's console logging goes to the redirected streams, i.e. to the client
+        PrintStream out = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(out);
+        System.setErr(out);
+
+        // WebinCli.main() ends with System.exit(), __main() returns the exit code instead
+        Method webinCli = Class.forName("uk.ac.ebi.ena.webin.cli.WebinCli").getMethod("__main", String[].class);
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            int returncode = 0;
+            try {
+                Object result = webinCli.invoke(null, (Object) line.split(ARG_SEP, -1));
+                if (result instanceof Integer) {
+                    returncode = (Integer) result;
+                }
+            } catch (InvocationTargetException e) {
+                e.getCause().printStackTrace(out);
+                if (e.getCause() instanceof OutOfMemoryError) {
+                    // no exit line: the client sees the server go away and starts a new one
+                    System.exit(1);
+                }
+                returncode = 1;
+            }
+            out.println(EXIT_MARKER + " " + returncode);
+        }
+    }
+}
@@ -1,10 +1,13 @@
 from dataclasses import dataclass
 
+from .slots import as_dict, intern, slotted
+
 
 DESCRIPTION = """
 SPIRE v01 primary metagenome assembly for {accessions}. For more details see https://spire.embl.de/spire/v1/genome/{sample_id}
 """.strip()
 
+@slotted
 @dataclass
 class Manifest:
     study: str = None
@@ -18,11 +21,16 @@ class Manifest:
     coverage: int = None
     description: str = ""
 
+    def __post_init__(self):
+        for field_name in ("study", "assembly_type", "program", "platform", "moleculetype",):
+            setattr(self, field_name, intern(getattr(self, field_name)))
+
     def to_str(self):
         return "\n".join(
             f"{k.upper()}   {v}"
-            for k, v in self.__dict__.items()
-            if v
+            for k, v in as_dict(self).items()
+            # COVERAGE 0 is a valid value
+            if v is not None and v != ""
         )
 
     @classmethod
@@ -38,3 +46,16 @@ class Manifest:
             coverage=assembly.coverage,
             description=DESCRIPTION.format(accessions=ena_sample, sample_id=assembly.sample_id),
         )
+
+    @classmethod
+    def from_file(cls, manifest_file):
+        fields = {}
+        with open(manifest_file, "rt", encoding="UTF-8",) as _in:
+            for line in _in:
+                if not line.strip():
+                    continue
+                key, *value = line.strip().split(maxsplit=1)
+                key = key.lower()
+                if key in cls.__dataclass_fields__:
+                    fields[key] = value[0] if value else None
+        return cls(**fields)
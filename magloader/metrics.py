@@ -0,0 +1,194 @@
+import collections
+import contextlib
+import json
+import os
+import pathlib
+import statistics
+import time
+
+from dataclasses import dataclass, field
+
+
+METRICS_FILE = "metrics.jsonl"
+# min. seconds between two prometheus textfile exports during a run
+PROMETHEUS_INTERVAL = 30.0
+
+
+class Metrics:
+    """Appends timing/throughput records as json lines to <workdir>/metrics.jsonl.
+
+    Only plain attributes are kept, so the object can be handed to worker processes;
+    each record is written with a single O_APPEND write and lines from concurrent writers do not interleave.
+    Without a metrics file, all calls are no-ops.
+    """
+    def __init__(self, metrics_file=None, run_id=None, prometheus_file=None,):
+        self.metrics_file = str(metrics_file) if metrics_file else None
+        self.run_id = run_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.prometheus_file = str(prometheus_file) if prometheus_file else None
+        self.last_export = 0.0
+
+    def emit(self, metric, value, **labels):
+        if self.metrics_file is None:
+            return
+        record = {"ts": time.time(), "run_id": self.run_id, "metric": metric, "value": value, **labels}
+        line = (json.dumps(record) + "\n").encode()
+        fd = os.open(self.metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def timed(self, metric, **labels):
+        # labels can be amended inside the block, e.g. with the outcome of the timed call
+        t0 = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.emit(metric, time.perf_counter() - t0, **labels)
+
+    def export(self, force=False):
+        if self.metrics_file is None or self.prometheus_file is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_export < PROMETHEUS_INTERVAL:
+            return
+        self.last_export = now
+        run_stats = get_run_stats(read_metrics(self.metrics_file)).get(self.run_id)
+        if run_stats is not None:
+            write_prometheus(run_stats, self.prometheus_file)
+
+
+NO_METRICS = Metrics()
+
+
+def get_metrics(workdir, prometheus_file=None,):
+    return Metrics(pathlib.Path(workdir) / METRICS_FILE, prometheus_file=prometheus_file,)
+
+
+def read_metrics(metrics_file):
+    with open(metrics_file, "rt", encoding="UTF-8",) as _in:
+        for line in _in:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # last line of an interrupted run
+                continue
+
+
+def get_percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+@dataclass
+class RunStats:
+    run_id: str = None
+    started: float = None
+    finished: float = None
+    stages: dict = field(default_factory=dict)
+    webin: dict = field(default_factory=lambda: collections.defaultdict(list))
+    http: list = field(default_factory=list)
+    http_errors: int = 0
+    submissions: dict = field(default_factory=lambda: collections.defaultdict(list))
+    assemblies: collections.Counter = field(default_factory=collections.Counter)
+    upload_seconds: float = 0.0
+    queue_depth: list = field(default_factory=list)
+    workers: list = field(default_factory=list)
+    retries: int = 0
+
+    @property
+    def assemblies_per_minute(self):
+        return 60.0 * self.assemblies["done"] / self.upload_seconds if self.upload_seconds else 0.0
+
+    def summary(self):
+        lines = [
+            f"run {self.run_id}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}, {self.finished - self.started:.1f}s",
+            f"  assemblies: {self.assemblies['done']} done, {self.assemblies['failed']} failed, {self.retries} retries, {self.assemblies_per_minute:.2f}/min",
+        ]
+        lines += (f"  stage {stage}: {seconds:.2f}s" for stage, seconds in self.stages.items())
+        for action, seconds in self.webin.items():
+            lines.append(
+                f"  webin-cli {action}: n={len(seconds)} mean={statistics.mean(seconds):.1f}s "
+                f"p50={get_percentile(seconds, 0.5):.1f}s p95={get_percentile(seconds, 0.95):.1f}s max={max(seconds):.1f}s"
+            )
+        for obj_type, seconds in self.submissions.items():
+            lines.append(f"  {obj_type} submissions: n={len(seconds)} mean={statistics.mean(seconds):.2f}s max={max(seconds):.2f}s")
+        if self.http:
+            lines.append(
+                f"  http: n={len(self.http)} errors={self.http_errors} mean={statistics.mean(self.http):.2f}s "
+                f"p95={get_percentile(self.http, 0.95):.2f}s"
+            )
+        if self.queue_depth:
+            lines.append(f"  queue depth: max={max(self.queue_depth)} mean={statistics.mean(self.queue_depth):.1f}")
+        if self.workers:
+            lines.append(f"  adaptive workers: min={min(self.workers)} max={max(self.workers)} mean={statistics.mean(self.workers):.1f}")
+        return "\n".join(lines)
+
+
+def get_run_stats(records):
+    runs = {}
+    for record in records:
+        run = runs.get(record["run_id"])
+        if run is None:
+            run = runs[record["run_id"]] = RunStats(run_id=record["run_id"], started=record["ts"], finished=record["ts"],)
+        run.finished = max(run.finished, record["ts"])
+
+        metric, value = record["metric"], record["value"]
+        if metric == "stage_seconds":
+            run.stages[record["stage"]] = run.stages.get(record["stage"], 0.0) + value
+        elif metric == "webin_seconds":
+            run.webin[record["action"]].append(value)
+        elif metric == "http_seconds":
+            run.http.append(value)
+            run.http_errors += record.get("status") is None or record["status"] >= 500
+        elif metric == "submit_seconds":
+            run.submissions[record["obj_type"]].append(value)
+        elif metric == "assembly_uploaded":
+            run.assemblies[record["status"]] += 1
+            run.upload_seconds = max(run.upload_seconds, value)
+        elif metric == "queue_depth":
+            run.queue_depth.append(value)
+        elif metric == "webin_retry":
+            run.retries += 1
+        elif metric == "workers":
+            run.workers.append(value)
+    return runs
+
+
+def write_prometheus(run_stats, prometheus_file):
+    # node_exporter textfile collector format, written atomically
+    lines = [
+        "# TYPE magloader_assemblies_total counter",
+        *(f'magloader_assemblies_total{{status="{status}"}} {n}' for status, n in sorted(run_stats.assemblies.items())),
+        "# TYPE magloader_assemblies_per_minute gauge",
+        f"magloader_assemblies_per_minute {run_stats.assemblies_per_minute:.4f}",
+        "# TYPE magloader_stage_seconds gauge",
+        *(f'magloader_stage_seconds{{stage="{stage}"}} {seconds:.3f}' for stage, seconds in run_stats.stages.items()),
+        "# TYPE magloader_webin_seconds summary",
+    ]
+    for action, seconds in run_stats.webin.items():
+        lines += [
+            f'magloader_webin_seconds_sum{{action="{action}"}} {sum(seconds):.3f}',
+            f'magloader_webin_seconds_count{{action="{action}"}} {len(seconds)}',
+        ]
+    lines += [
+        "# TYPE magloader_http_seconds summary",
+        f"magloader_http_seconds_sum {sum(run_stats.http):.3f}",
+        f"magloader_http_seconds_count {len(run_stats.http)}",
+        "# TYPE magloader_http_errors_total counter",
+        f"magloader_http_errors_total {run_stats.http_errors}",
+        "# TYPE magloader_queue_depth gauge",
+        f"magloader_queue_depth {run_stats.queue_depth[-1] if run_stats.queue_depth else 0}",
+        "# TYPE magloader_webin_retries_total counter",
+        f"magloader_webin_retries_total {run_stats.retries}",
+        "# TYPE magloader_workers gauge",
+        f"magloader_workers {run_stats.workers[-1] if run_stats.workers else 0}",
+        "# TYPE magloader_last_update_seconds gauge",
+        f"magloader_last_update_seconds {run_stats.finished:.0f}",
+    ]
+    prometheus_file = pathlib.Path(prometheus_file)
+    tmp_file = prometheus_file.with_name(f".{prometheus_file.name}.tmp")
+    with open(tmp_file, "wt", encoding="UTF-8",) as _out:
+        print(*lines, sep="\n", file=_out,)
+    os.replace(tmp_file, prometheus_file)
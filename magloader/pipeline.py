@@ -0,0 +1,389 @@
+""" Stages of a magloader run shared by the single-study (magloader) and batch (magloader batch) entry points. """
+
+import itertools
+import json
+import pathlib
+import shlex
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+
+from .assembly import Assembly
+from .metrics import NO_METRICS
+from .preflight import preflight
+from .resources import AdaptiveScheduler, HeapModel, parse_memory, TimeoutModel
+from .sample import SampleSet
+from .study import STUDY_TYPES
+from .submission import Submission, SubmissionResponse
+from .upload import as_completed_bounded, prepare_manifest_files, process_manifest, read_heap_runs, reconcile_assemblies, HEAP_RUNS, RetryPolicy, VALIDATION_MODES
+from .webin import classify_messages, JVM_OPTS, SERVER_SOURCE, WEBIN_CLI
+
+
+
+
+def get_missing_aliases(obj, response):
+    # aliases of a submitted object set (e.g. a SampleSet) that a cached receipt does not account for
+    get_aliases = getattr(obj, "get_aliases", None)
+    if get_aliases is None:
+        return set()
+    return get_aliases().difference(item.alias for item in response.objects)
+
+
+def register_object(user, pw, obj, obj_type, hold_date=None, dev=True, timeout=60, outdir=None, session=None, retries=3, dropbox_url=None, state=None, metrics=None,):
+    metrics = metrics or NO_METRICS
+    response = None
+    obj_json = pathlib.Path(outdir or ".") / f"{obj_type}_response.json"
+
+    response_json = state.get_response(obj_json) if state is not None else None
+    if response_json is None and obj_json.is_file():
+        # receipt from a run without state store
+        with open(obj_json, "rt") as _in:
+            response_json = _in.read()
+    if response_json is not None:
+        try:
+            response = SubmissionResponse.from_json(response_json)
+        except Exception as err:
+            print(f"Reading {obj_type} submission failed.\n\n", err )
+            response = None
+        else:
+            missing = get_missing_aliases(obj, response)
+            if missing:
+                # receipt of a differently composed submission, e.g. from a run with other chunk sizes:
+                # submit again, ENA reports the existing objects' accessions
+                print(f"{obj_json} does not cover {len(missing)} {obj_type}(s), e.g. {min(missing)}, resubmitting.")
+                response = None
+            elif state is not None:
+                state.set_response(obj_json, obj_type, response)
+    if response is None:
+        sub = Submission(user, pw, hold_date=hold_date, dev=dev, timeout=timeout, session=session, retries=retries, url=dropbox_url, metrics=metrics,)
+        with metrics.timed("submit_seconds", obj_type=obj_type,) as labels:
+            response = sub.submit(obj, outdir=outdir,)
+            labels["success"] = response.success
+        # failed receipts are kept as long as they account for every object, e.g. when all samples
+        # already existed and their accessions were recovered; otherwise they are retried on the next run
+        if response.success or (response.objects and not get_missing_aliases(obj, response)):
+            if state is not None:
+                state.set_response(obj_json, obj_type, response)
+            else:
+                with open(obj_json, "wt") as _out:
+                    _out.write(response.to_json())
+
+    print(response)
+
+    yield from response.objects
+
+
+def register_object_chunks(user, pw, obj_chunks, obj_type, outdir, threads=1, always_chunked=False, **kwargs,):
+    # a single chunk keeps its receipt in outdir, unless always_chunked (several callers share outdir)
+    obj_chunks = list(obj_chunks)
+    if len(obj_chunks) == 1 and not always_chunked:
+        yield from register_object(user, pw, obj_chunks[0], obj_type, outdir=outdir, **kwargs,)
+        return
+
+    def register_chunk(chunk):
+        i, obj = chunk
+        # keyed by content, a receipt is only reused for the same samples
+        chunk_dir = pathlib.Path(outdir) / f"chunk_{obj.get_key()}"
+        chunk_dir.mkdir(exist_ok=True, parents=True,)
+        try:
+            return list(register_object(user, pw, obj, obj_type, outdir=chunk_dir, **kwargs,))
+        except requests.RequestException as err:
+            print(f"Submitting {obj_type} chunk {i} failed.\n\n", err)
+            return []
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for objects in as_completed_bounded(pool, register_chunk, enumerate(obj_chunks, start=1), threads):
+            yield from objects
+
+
+def add_arguments(ap):
+    ap.add_argument("webin_credentials", type=str)
+    ap.add_argument("--override", action="store_true",)  # not used at the moment
+    ap.add_argument("--workdir", "-w", type=str, default="work")
+    ap.add_argument("--hold_date", type=str, default="2025-12-31")
+    ap.add_argument("--dryruns", type=int, default=0)
+    ap.add_argument("--ena_live", action="store_true")
+    ap.add_argument("--threads", type=int, default=1)
+    ap.add_argument("--max_pending", type=int, default=None,)  # max. manifests queued/in flight at once, default: 2 * threads
+    ap.add_argument("--executor", choices=("thread", "process",), default="thread",)  # webin-cli runs are subprocesses, threads are sufficient
+    ap.add_argument("--java_max_heap", type=str, default=None,)  # fixed -Xmx for all assemblies, overrides --auto_heap
+    ap.add_argument("--auto_heap", action="store_true",)  # size -Xmx per assembly from its fasta size, retry once on OutOfMemoryError
+    ap.add_argument("--heap_base", type=str, default="1g",)  # min. -Xmx with --auto_heap
+    ap.add_argument("--heap_per_gb", type=str, default="2g",)  # -Xmx per GB of compressed fasta with --auto_heap
+    ap.add_argument("--heap_ceiling", type=str, default="16g",)  # max. -Xmx with --auto_heap
+    ap.add_argument("--timeout", type=int, default=60,)
+    ap.add_argument("--input_chunk_size", type=int, default=None,)  # max. assemblies read from the study input at once
+    ap.add_argument("--sample_chunk_size", type=int, default=None,)  # max. samples per submission
+    ap.add_argument("--sample_chunk_bytes", type=int, default=None,)  # max. sample xml size per submission
+    ap.add_argument("--sample_threads", type=int, default=1,)  # max. concurrent sample submissions
+    ap.add_argument("--http_retries", type=int, default=3,)
+    ap.add_argument("--dropbox_url", type=str, default=None,)  # override the ENA drop-box endpoint, e.g. with a local stand-in
+    ap.add_argument("--validation_mode", choices=VALIDATION_MODES, default="skip-known-good",)
+    ap.add_argument("--skip_preflight", action="store_true",)  # do not check manifests and fasta files before running webin-cli
+    ap.add_argument("--webin_cli", type=str, default=WEBIN_CLI,)  # webin-cli launcher command, JVM options go to its {jvm_opts} token, e.g. "java {jvm_opts} -jar webin-cli.jar"
+    ap.add_argument("--java_opts", type=str, default=None,)  # additional JVM options for webin-cli, e.g. "-XX:+UseSerialGC -Xshare:auto"
+    ap.add_argument("--webin_cli_jar", type=str, default=None,)  # run webin-cli from this jar in one persistent JVM per worker (java 11+)
+    ap.add_argument("--webin_cli_server", type=str, default=None,)  # command starting a persistent webin-cli server, overrides --webin_cli_jar
+    ap.add_argument("--abort_on_error", action="store_true",)  # terminate webin-cli on the first error that a retry would not fix
+    ap.add_argument("--webin_timeout", type=float, default=1800.0,)  # watchdog timeout (s) per webin-cli run for an empty fasta, 0: no watchdog
+    ap.add_argument("--webin_timeout_per_gb", type=float, default=3600.0,)  # additional seconds per GB of compressed fasta
+    ap.add_argument("--webin_timeout_ceiling", type=float, default=86400.0,)
+    ap.add_argument("--webin_retries", type=int, default=2,)  # re-queue attempts per manifest after transient webin-cli errors and timeouts
+    ap.add_argument("--webin_retry_backoff", type=float, default=60.0,)  # base delay (s) before a re-queued manifest runs again
+    ap.add_argument("--prometheus_textfile", type=str, default=None,)  # also export run metrics for the node_exporter textfile collector
+    ap.add_argument("--adaptive", action="store_true",)  # scale concurrent webin-cli runs between --min_threads and --threads with free memory/load
+    ap.add_argument("--min_threads", type=int, default=1,)
+    ap.add_argument("--worker_memory", type=str, default=None,)  # expected webin-cli footprint before one has been measured, default: java_max_heap or 2g
+    ap.add_argument("--mem_reserve", type=str, default="2g",)  # memory kept free when adding workers
+
+
+def get_workdir(workdir, override=False):
+    workdir = pathlib.Path(workdir)
+    if workdir.is_dir():
+        if override:
+            raise NotImplementedError("Workdir override not implemented.")
+    else:
+        workdir.mkdir(parents=True)
+    return workdir
+
+
+def read_study_data(study_json):
+    # json: one document with an "assemblies" list
+    # jsonl (magquery --output_format jsonl): study record on the first line, then one assembly per line, read lazily
+    study_json = pathlib.Path(study_json)
+    if study_json.suffix == ".jsonl":
+        json_in = open(study_json, "rt", encoding="UTF-8",)
+        study_data = json.loads(json_in.readline())
+
+        def read_assemblies():
+            with json_in:
+                for line in json_in:
+                    if line.strip():
+                        yield json.loads(line)
+
+        return study_data, read_assemblies()
+
+    with open(study_json, "rt", encoding="UTF-8",) as json_in:
+        study_data = json.load(json_in)
+    return study_data, iter(study_data.pop("assemblies"))
+
+
+def chunked(items, chunk_size=None):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def prepare_study(study_json, workdir, args, user, pw, session, state, metrics=None,):
+    metrics = metrics or NO_METRICS
+    run_on_dev_server = not args.ena_live
+
+    study_data, assembly_data = read_study_data(study_json)
+
+    print(study_data)
+
+    study_id = None
+
+    StudyType = STUDY_TYPES.get(study_data.get("study_type", "ena"))
+
+    study_obj = StudyType(study_id=study_data["study_id"], raw_data_projects=study_data["accessions"],)
+    print(study_obj)
+
+    # register bioproject
+    study_dir = pathlib.Path(workdir / "study")
+    study_dir.mkdir(exist_ok=True, parents=True,)
+    with metrics.timed("stage_seconds", stage="register_study",):
+        studies = register_object(
+            user, pw, study_obj, "study",
+            hold_date=args.hold_date, dev=run_on_dev_server, outdir=study_dir,
+            session=session, retries=args.http_retries, dropbox_url=args.dropbox_url, state=state, metrics=metrics,
+        )
+        studies = list(studies)
+    print(*studies, sep="\n")
+
+    study_id = studies[0].accession
+
+    if study_id is None:
+        raise ValueError("No study id.")
+
+    assembly_data = (
+        assembly
+        for i, assembly in enumerate(assembly_data)
+        if not run_on_dev_server or (args.dryruns <= 0 or i < args.dryruns)
+    )
+
+    # assemblies are read and registered in input chunks, only the current chunk is held in memory
+    input_chunks = chunked(assembly_data, args.input_chunk_size)
+    first_chunk, second_chunk = next(input_chunks, []), next(input_chunks, None)
+    if second_chunk is None:
+        input_chunks = [(None, first_chunk)]
+    else:
+        input_chunks = enumerate(itertools.chain([first_chunk, second_chunk], input_chunks), start=1)
+
+    manifests = []
+    for k, assembly_chunk in input_chunks:
+        # load assembly data and extract samples
+        assemblies = {
+            f"spire_sample_{assembly['sample_id']}": Assembly(**assembly, spire_ena_project_id=study_id)
+            for assembly in assembly_chunk
+        }
+
+        biosamples = []
+
+        sample_set = SampleSet()
+        sample_set.samples += (assembly.get_sample() for assembly in assemblies.values())
+        print(f"Registering {len(sample_set.samples)} samples.")
+
+        # register biosamples: receipts of sample chunks are shared by all input chunks,
+        # as chunks are keyed by their samples, they are reused when the input chunk size changes
+        samples_dir = pathlib.Path(workdir / "samples")
+        sample_dir = samples_dir
+        if k is not None:
+            sample_dir = sample_dir / f"input_{sample_set.get_key()}"
+        sample_dir.mkdir(exist_ok=True, parents=True,)
+        biosamples = register_object_chunks(
+            user, pw,
+            sample_set.chunks(chunk_size=args.sample_chunk_size, max_bytes=args.sample_chunk_bytes,),
+            "sample",
+            samples_dir,
+            threads=args.sample_threads,
+            always_chunked=k is not None,
+            hold_date=args.hold_date,
+            dev=run_on_dev_server,
+            timeout=args.timeout,
+            session=session,
+            retries=args.http_retries,
+            dropbox_url=args.dropbox_url,
+            state=state,
+            metrics=metrics,
+        )
+        with metrics.timed("stage_seconds", stage="register_samples",):
+            biosamples = list(biosamples)
+
+        print(biosamples, sep="\n")
+
+        # validate and submit assemblies
+        print(assemblies)
+
+        reconciliation = reconcile_assemblies(biosamples, assemblies)
+        reconciliation.write(sample_dir / "reconciliation.tsv")
+        print("RECONCILIATION", reconciliation)
+        for biosample in reconciliation.receipt_only:
+            print(f"{biosample.alias} does not have an assembly!")
+        for alias in reconciliation.assembly_only:
+            print(f"{alias} does not have a biosample accession!")
+
+        with metrics.timed("stage_seconds", stage="prepare_manifests",):
+            manifests += prepare_manifest_files(study_id, reconciliation.matched, workdir, state=state,)
+
+    return manifests
+
+
+def run_preflight(manifests, args, get_state, metrics=None,):
+    # yields the manifests that pass as they are checked, so that webin-cli can start
+    # on the first one while the rest are still being read
+    if args.skip_preflight:
+        yield from manifests
+        return
+
+    t0 = time.perf_counter()
+    try:
+        for result in preflight(manifests, threads=args.threads, max_pending=args.max_pending,):
+            if result.errors:
+                print("PREFLIGHT FAILED", result.manifest, *result.errors, sep="\n",)
+                get_state(result.manifest).set_assembly_status(result.manifest, "preflight_failed", messages=result.errors, attempt=False,)
+            else:
+                print("PREFLIGHT OK", result.manifest, result.stats, sep="\n",)
+                yield result.manifest
+    finally:
+        if metrics is not None:
+            # overlaps with the upload stage
+            metrics.emit("stage_seconds", time.perf_counter() - t0, stage="preflight",)
+
+
+def get_webin_cli_server(args):
+    if args.webin_cli_server:
+        return args.webin_cli_server
+    if args.webin_cli_jar:
+        return f"java {JVM_OPTS} -cp {shlex.quote(args.webin_cli_jar)} {shlex.quote(str(SERVER_SOURCE))}"
+    return None
+
+
+def get_process_manifest_partial(args, user, pw, metrics=None, heap_model=None,):
+    return partial(
+        process_manifest,
+        user=user,
+        password=pw,
+        submit=True,
+        run_on_dev_server=not args.ena_live,
+        java_max_heap=args.java_max_heap,
+        webin_cli=args.webin_cli,
+        webin_cli_server=get_webin_cli_server(args),
+        java_opts=args.java_opts,
+        validation_mode=args.validation_mode,
+        heap_model=heap_model,
+        abort_on_error=args.abort_on_error,
+        timeout_model=get_timeout_model(args),
+        metrics=metrics,
+    )
+
+
+def get_heap_model(args, states):
+    if not args.auto_heap or args.java_max_heap:
+        return None
+    heap_model = HeapModel(base=parse_memory(args.heap_base), per_gb=parse_memory(args.heap_per_gb), ceiling=parse_memory(args.heap_ceiling),)
+    # heap runs recorded in the workdir(s) adjust the model before the first assembly is sized
+    for state in states:
+        heap_model.learn(state.get_heap_runs())
+    print(heap_model, f"{len(heap_model.assembly_heaps)} assemblies start above it after running out of memory")
+    return heap_model
+
+
+def get_timeout_model(args):
+    if not args.webin_timeout:
+        return None
+    return TimeoutModel(base=args.webin_timeout, per_gb=args.webin_timeout_per_gb, ceiling=args.webin_timeout_ceiling,)
+
+
+def get_retry_policy(args):
+    if args.webin_retries <= 0:
+        return None
+    return RetryPolicy(retries=args.webin_retries, backoff=args.webin_retry_backoff,)
+
+
+def get_scheduler(args):
+    if not args.adaptive:
+        return None
+    return AdaptiveScheduler(
+        min_workers=args.min_threads,
+        max_workers=args.threads,
+        worker_memory=args.worker_memory or args.java_max_heap or "2g",
+        mem_reserve=args.mem_reserve,
+    )
+
+
+def write_previous_accessions(state, _out):
+    # accessions from previous runs are kept in the state store
+    for ena_id, manifest in state.get_accessions():
+        print(ena_id, manifest, sep="\t", file=_out,)
+    _out.flush()
+
+
+def record_upload_result(state, ena_id, messages, manifest, _out):
+    heap_runs = read_heap_runs(pathlib.Path(manifest).parent)
+    if heap_runs:
+        state.add_heap_runs(manifest, heap_runs)
+        (pathlib.Path(manifest).parent / HEAP_RUNS).unlink()
+    if ena_id is not None:
+        state.set_assembly_status(manifest, "done", accession=ena_id,)
+        print(ena_id, manifest, sep="\t", file=_out, flush=True,)
+    else:
+        # rejected: invalid input, needs fixing before another attempt; failed: transient errors or retries used up
+        status = "rejected" if classify_messages(messages) == "permanent" else "failed"
+        state.set_assembly_status(manifest, status, messages=messages,)
@@ -0,0 +1,173 @@
+import gzip
+import io
+import json
+import os
+import pathlib
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from .manifest import Manifest
+from .upload import as_completed_bounded
+
+
+# IUPAC nucleotide codes accepted by ENA in assembly fasta files
+NUCLEOTIDES = b"ACGTURYSWKMBDHVNacgturyswkmbdhvn"
+REQUIRED_FIELDS = ("study", "sample", "assemblyname", "program", "platform", "fasta", "coverage",)
+
+PREFLIGHT_CACHE = "preflight.json"
+READ_BUFFER_SIZE = 1 << 20
+
+
+@dataclass
+class FastaStats:
+    fasta: str = None
+    size: int = None
+    mtime_ns: int = None
+    n_contigs: int = 0
+    total_length: int = 0
+    n50: int = 0
+    errors: list = field(default_factory=list)
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+    @classmethod
+    def from_json(cls, json_str):
+        return cls(**json.loads(json_str))
+
+
+@dataclass
+class PreflightResult:
+    manifest: pathlib.Path = None
+    stats: FastaStats = None
+    errors: list = field(default_factory=list)
+
+
+def get_n50(lengths, total_length):
+    running_length = 0
+    for length in sorted(lengths, reverse=True):
+        running_length += length
+        if 2 * running_length >= total_length:
+            return length
+    return 0
+
+
+def scan_fasta(fasta):
+    fasta = pathlib.Path(fasta)
+    stats = FastaStats(fasta=str(fasta))
+
+    try:
+        fasta_stat = fasta.stat()
+    except FileNotFoundError:
+        # also covers dangling symlinks from magquery
+        stats.errors.append(f"{fasta} does not exist.")
+        return stats
+
+    stats.size, stats.mtime_ns = fasta_stat.st_size, fasta_stat.st_mtime_ns
+    if not stats.size:
+        stats.errors.append(f"{fasta} is empty.")
+        return stats
+
+    lengths, length, header_seen = [], None, False
+    try:
+        with io.BufferedReader(gzip.open(fasta, "rb"), buffer_size=READ_BUFFER_SIZE) as fasta_in:
+            for i, line in enumerate(fasta_in, start=1):
+                line = line.rstrip()
+                if line[:1] == b">":
+                    if len(line) == 1 or line[1:2].isspace():
+                        stats.errors.append(f"{fasta}: empty header in line {i}.")
+                        break
+                    if length == 0:
+                        stats.errors.append(f"{fasta}: contig without sequence before line {i}.")
+                        break
+                    if length is not None:
+                        lengths.append(length)
+                    length, header_seen = 0, True
+                elif line:
+                    if not header_seen:
+                        stats.errors.append(f"{fasta}: sequence data before first header.")
+                        break
+                    if line.translate(None, NUCLEOTIDES):
+                        stats.errors.append(f"{fasta}: invalid sequence characters in line {i}.")
+                        break
+                    length += len(line)
+    except (EOFError, OSError, zlib.error) as err:
+        stats.errors.append(f"{fasta}: truncated or corrupt gzip stream ({err}).")
+        return stats
+
+    if length:
+        lengths.append(length)
+    elif length == 0 and not stats.errors:
+        stats.errors.append(f"{fasta}: last contig has no sequence.")
+
+    if not lengths and not stats.errors:
+        stats.errors.append(f"{fasta} does not contain any contigs.")
+
+    stats.n_contigs = len(lengths)
+    stats.total_length = sum(lengths)
+    stats.n50 = get_n50(lengths, stats.total_length)
+
+    return stats
+
+
+def check_manifest_fields(manifest):
+    for field_name in REQUIRED_FIELDS:
+        if getattr(manifest, field_name) in (None, ""):
+            yield f"{field_name.upper()} is missing."
+
+    if manifest.coverage not in (None, ""):
+        try:
+            coverage = float(manifest.coverage)
+        except ValueError:
+            yield f"COVERAGE {manifest.coverage} is not a number."
+        else:
+            # webin-cli: "Invalid field value. Non-negative float expected."
+            if coverage < 0.0:
+                yield f"COVERAGE {manifest.coverage} is negative."
+
+
+def get_fasta_stats(fasta, cache_file):
+    try:
+        fasta_stat = os.stat(fasta)
+    except OSError:
+        fasta_stat = None
+
+    if fasta_stat is not None and cache_file.is_file():
+        with open(cache_file, "rt", encoding="UTF-8",) as _in:
+            try:
+                stats = FastaStats.from_json(_in.read())
+            except Exception:
+                stats = None
+        if stats is not None and (stats.fasta, stats.size, stats.mtime_ns) == (str(fasta), fasta_stat.st_size, fasta_stat.st_mtime_ns):
+            return stats
+
+    stats = scan_fasta(fasta)
+    if stats.size is not None:
+        with open(cache_file, "wt", encoding="UTF-8",) as _out:
+            _out.write(stats.to_json())
+
+    return stats
+
+
+def check_manifest(manifest_file):
+    manifest_file = pathlib.Path(manifest_file)
+    manifest = Manifest.from_file(manifest_file)
+
+    errors = list(check_manifest_fields(manifest))
+    stats = None
+    if manifest.fasta:
+        # webin-cli runs in the manifest's directory, relative paths are resolved from there
+        stats = get_fasta_stats(manifest_file.parent / manifest.fasta, manifest_file.parent / PREFLIGHT_CACHE)
+        errors += stats.errors
+
+    return PreflightResult(manifest=manifest_file, stats=stats, errors=errors,)
+
+
+def preflight(manifests, threads=1, max_pending=None,):
+    if threads == 1:
+        yield from (check_manifest(manifest) for manifest in manifests)
+    else:
+        with ProcessPoolExecutor(max_workers=threads) as pool:
+            yield from as_completed_bounded(pool, check_manifest, manifests, max_pending or 2 * threads)
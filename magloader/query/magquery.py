@@ -1,84 +1,143 @@
 import argparse
+import itertools
 import json
 import os
 import pathlib
 import pprint
 
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("study_id", type=str)
-    ap.add_argument("db_json", type=str)
-    ap.add_argument("--spire_version", type=int, choices=(1,2,), default=1)
-    ap.add_argument("--assembly_dir", type=str, default="assemblies")
-    ap.add_argument("--study_type", choices=("ena", "mg-rast", "metasub", "internal", "ena_mg-rast",), default="ena",)
-    args = ap.parse_args()
+ASSEMBLY_SOURCE = "/g/scb/bork/data/spire/studies/{study_id}/psa_megahit/assemblies/{sample_name}-assembled.fa.gz"
 
-    assembly_dir = pathlib.Path(args.assembly_dir)
-    assembly_dir.mkdir(exist_ok=True, parents=True,)
 
-    with open(args.db_json, "rt", encoding="UTF-8",) as json_in:
-        db = json.load(json_in)
+class SymlinkStager:
+    # creates assembly symlinks in batches across a thread pool,
+    # target checks on the (slow, networked) source filesystem run concurrently
+    def __init__(self, assembly_dir, threads=8, batch_size=1000,):
+        self.assembly_dir = pathlib.Path(assembly_dir)
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.batch = []
+        self.seen = set()
+        self.dangling = []
+        self.n_created = self.n_skipped = 0
+        # one directory scan instead of a failing symlink call per existing link
+        with os.scandir(self.assembly_dir) as entries:
+            self.existing = {entry.name: entry.is_symlink() for entry in entries}
 
-    connection = psycopg2.connect(**db)
-    print("connected")
+    def __enter__(self):
+        return self
 
-    cursor = connection.cursor()
-    print("got cursor")
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, link, target):
+        if link.name not in self.seen:
+            self.seen.add(link.name)
+            self.batch.append((link, target))
+            if len(self.batch) >= self.batch_size:
+                self.flush()
 
-    json_d = {
-        "study_id": args.study_id,
-        "study_name": "",
-        "study_type": args.study_type,
-        "accessions": "",
+    def flush(self):
+        for link, target, exists, created in self.pool.map(self.stage_link, self.batch):
+            if not exists:
+                self.dangling.append((link, target))
+            if created:
+                self.n_created += 1
+            else:
+                self.n_skipped += 1
+        self.batch.clear()
+
+    def stage_link(self, job):
+        link, target = job
+        exists = os.path.exists(target)
+        is_symlink = self.existing.get(link.name)
+        if is_symlink is not None:
+            if not is_symlink or os.readlink(link) == target:
+                return link, target, exists, False
+            link.unlink()
+        link.symlink_to(target)
+        return link, target, exists, True
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+        print(f"assembly links: {self.n_created} created, {self.n_skipped} already present, {len(self.dangling)} dangling")
+        for link, target in self.dangling:
+            print("DANGLING", link, target, sep="\t")
+
+
+def get_study_ids(study_ids, study_file=None):
+    # accepts comma-separated ids and ranges, e.g. 1,5,10-20
+    specs = study_ids.split(",") if study_ids else []
+    if study_file:
+        with open(study_file, "rt", encoding="UTF-8",) as _in:
+            specs += [line.strip() for line in _in if line.strip()]
+
+    ids = []
+    for spec in specs:
+        start, _, end = spec.partition("-")
+        ids += range(int(start), int(end or start) + 1)
+    return sorted(set(ids))
+
+
+def get_study_data(cursor, study_ids, study_type):
+    studies = {
+        study_id: {
+            "study_id": str(study_id),
+            "study_name": "",
+            "study_type": study_type,
+            "accessions": "",
+        }
+        for study_id in study_ids
     }
+    accessions = {study_id: [] for study_id in study_ids}
 
-    if args.study_type == "ena":
+    if study_type in ("mg-rast", "metasub", "internal",):
+        cursor.execute(
+            "SELECT id, study_name FROM studies WHERE id = ANY(%s);", (study_ids,),
+        )
+        for study_id, study_name in cursor.fetchall():
+            studies[study_id]["study_name"] = study_name
+
+    if study_type == "ena":
         cursor.execute(
             "SELECT DISTINCT "
-            "study_accession, study_name "
+            "study_id, study_accession, study_name "
             "FROM "
             "("
-            "	SELECT ena.study_accession, studies.study_name "
+            "	SELECT studies.id AS study_id, ena.study_accession, studies.study_name "
             "	FROM studies "
             "	LEFT OUTER JOIN ena ON ena.study_id = studies.id "
-            f"  WHERE studies.id = {args.study_id}"
-            ") AS studies_ena;"
-        )
-        json_d["accessions"] = ";".join(
-            acc if acc else ""
-            for acc, json_d["study_name"]
-            in cursor.fetchall()
-        )
-    elif args.study_type == "mg-rast":
-        cursor.execute(
-            f"SELECT study_name FROM studies WHERE id = {args.study_id};"
+            "  WHERE studies.id = ANY(%s)"
+            ") AS studies_ena;",
+            (study_ids,),
         )
-        json_d["study_name"] = list(cursor.fetchall())[0][0]
-
+        for study_id, acc, study_name in cursor.fetchall():
+            studies[study_id]["study_name"] = study_name
+            accessions[study_id].append(acc if acc else "")
+    elif study_type == "mg-rast":
         cursor.execute(
             "SELECT DISTINCT "
-            "(split_part(sample_name, '_', 1)) "
+            "study_id, (split_part(sample_name, '_', 1)) "
             "FROM samples "
-            f"WHERE study_id = {args.study_id};"
-        )
-        json_d["accessions"] = ";".join(
-            acc[0] if acc[0] else ""
-            for acc
-            in cursor.fetchall()
-        )
-    elif args.study_type == "metasub" or args.study_type == "internal":
-        cursor.execute(
-            f"SELECT study_name FROM studies WHERE id = {args.study_id};"
+            "WHERE study_id = ANY(%s);",
+            (study_ids,),
         )
-        json_d["study_name"] = list(cursor.fetchall())[0][0]
+        for study_id, acc in cursor.fetchall():
+            accessions[study_id].append(acc if acc else "")
 
+    for study_id, study_accessions in accessions.items():
+        studies[study_id]["accessions"] = ";".join(study_accessions)
 
-    
+    return studies
 
-    if args.spire_version == 1:
+
+def get_assembly_query(spire_version):
+    if spire_version == 1:
         assembly_query = "'null'"
         software_query = "'megahit'"
         software_version_query = "'1.2.9'"
@@ -91,9 +150,10 @@ def main():
         assembly_join = "JOIN assemblies on samples.id = assemblies.sample_id "
         software_join = "JOIN software on assemblies.assembler = software.id "
 
-    
-    cursor.execute(
+    # rows are ordered by study and sample, so that assemblies can be assembled in a single streaming pass
+    return (
         "SELECT "
+        "samples.study_id, "
         "samples.id as sample_id, "
         "samples.sample_name, "
         f"{assembly_query}, "
@@ -107,42 +167,124 @@ def main():
         f"{software_join}"
         "LEFT OUTER JOIN ena on ena.sample_id = samples.id "
         "LEFT OUTER JOIN average_coverage on average_coverage.sample_id = samples.id "
-        f"WHERE samples.study_id = {args.study_id};"
+        "WHERE samples.study_id = ANY(%s) "
+        "ORDER BY samples.study_id, samples.id;"
     )
 
-    assemblies = {}
-    for sample_id, sample_name, assembly_id, program, program_version, sample_accession, coverage in cursor.fetchall():
-        try:
-            coverage = float(coverage)
-        except:
-            coverage = -1.0
-
-        assembly_path = assembly_dir / f"{sample_name}-assembled.fa.gz"
-        try:
-            assembly_path.symlink_to(f"/g/scb/bork/data/spire/studies/{args.study_id}/psa_megahit/assemblies/{sample_name}-assembled.fa.gz")
-        except FileExistsError:
-            pass
-
-        assemblies.setdefault(sample_id, {}).update(
-            {
-                "sample_id": sample_id,			
-                "program": program,
-                "program_version": program_version,
-                "coverage": float(coverage),
-                "file_path": str(assembly_path.absolute()),
-            }
-        )
-        assemblies[sample_id].setdefault("biosamples", []).append(sample_name)
 
-    for assembly in assemblies.values():
-        assembly["biosamples"] = ";".join(assembly["biosamples"])
+def get_assemblies(connection, study_ids, spire_version, assembly_dir, stager, assembly_source=ASSEMBLY_SOURCE, itersize=10000,):
+    # named cursors are server-side, rows are fetched in batches of itersize
+    with connection.cursor(name="magquery_assemblies") as cursor:
+        cursor.itersize = itersize
+        cursor.execute(get_assembly_query(spire_version), (study_ids,))
+
+        for (study_id, sample_id), rows in itertools.groupby(cursor, key=lambda row: row[:2]):
+            assembly = {}
+            for _, _, sample_name, assembly_id, program, program_version, sample_accession, coverage in rows:
+                try:
+                    coverage = float(coverage)
+                except:
+                    coverage = -1.0
+
+                assembly_path = assembly_dir / f"{sample_name}-assembled.fa.gz"
+                stager.add(assembly_path, assembly_source.format(study_id=study_id, sample_name=sample_name))
+
+                assembly.update(
+                    {
+                        "sample_id": sample_id,
+                        "program": program,
+                        "program_version": program_version,
+                        "coverage": float(coverage),
+                        "file_path": str(assembly_path.absolute()),
+                    }
+                )
+                assembly.setdefault("biosamples", []).append(sample_name)
+
+            assembly["biosamples"] = ";".join(assembly["biosamples"])
+            yield study_id, assembly
+
+
+def write_study(json_d, assemblies, json_out, output_format="json",):
+    # streams the assemblies, the study is never held in memory as a whole
+    n_assemblies = 0
+    if output_format == "jsonl":
+        # first line: study, then one assembly per line
+        print(json.dumps(json_d), file=json_out)
+        for n_assemblies, assembly in enumerate(assemblies, start=1):
+            print(json.dumps(assembly), file=json_out)
+    else:
+        # same layout as json.dump(..., indent=4) of the full study
+        json_out.write(json.dumps(json_d, indent=4).rstrip("}").rstrip())
+        json_out.write(',\n    "assemblies": [\n')
+        for n_assemblies, assembly in enumerate(assemblies, start=1):
+            if n_assemblies > 1:
+                json_out.write(",\n")
+            json_out.write(
+                "\n".join(
+                    f"        {line}"
+                    for line in json.dumps(assembly, indent=4).split("\n")
+                )
+            )
+        json_out.write("\n    ]\n}\n")
+    return n_assemblies
 
-    json_d["assemblies"] = list(assemblies.values())
 
-    pprint.pprint(json_d)
+def write_studies(studies, assemblies, output_format="json",):
+    # assemblies arrive grouped by study, each study is streamed into its own file
+    written = set()
+    grouped_assemblies = itertools.groupby(assemblies, key=lambda item: item[0])
+    empty_studies = ((study_id, iter(())) for study_id in studies)
+    for study_id, study_assemblies in itertools.chain(grouped_assemblies, empty_studies):
+        if study_id in written:
+            continue
+        written.add(study_id)
+        with open(f"spire_study_{study_id}.{output_format}", "wt", encoding="UTF-8",) as json_out:
+            n_assemblies = write_study(
+                studies[study_id],
+                (assembly for _, assembly in study_assemblies),
+                json_out,
+                output_format=output_format,
+            )
+        print(f"study {study_id}: wrote {n_assemblies} assemblies")
 
-    with open(f"spire_study_{args.study_id}.json", "wt", encoding="UTF-8",) as json_out:
-        json.dump(json_d, json_out, indent=4,)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("study_id", type=str)  # study id(s), comma-separated ids and ranges are accepted, e.g. 1,5,10-20
+    ap.add_argument("db_json", type=str)
+    ap.add_argument("--study_file", type=str, default=None,)  # file with additional study ids/ranges, one per line
+    ap.add_argument("--spire_version", type=int, choices=(1,2,), default=1)
+    ap.add_argument("--assembly_dir", type=str, default="assemblies")
+    ap.add_argument("--study_type", choices=("ena", "mg-rast", "metasub", "internal", "ena_mg-rast",), default="ena",)
+    ap.add_argument("--output_format", choices=("json", "jsonl",), default="json",)
+    ap.add_argument("--itersize", type=int, default=10000,)  # rows per server-side cursor fetch
+    ap.add_argument("--assembly_source", type=str, default=ASSEMBLY_SOURCE,)  # link target template, {study_id} and {sample_name} are filled in
+    ap.add_argument("--link_threads", type=int, default=8,)  # threads for checking/creating assembly links
+    args = ap.parse_args()
+
+    study_ids = get_study_ids(args.study_id, study_file=args.study_file,)
+
+    assembly_dir = pathlib.Path(args.assembly_dir)
+    assembly_dir.mkdir(exist_ok=True, parents=True,)
+
+    with open(args.db_json, "rt", encoding="UTF-8",) as json_in:
+        db = json.load(json_in)
+
+    connection = psycopg2.connect(**db)
+    print("connected")
+
+    cursor = connection.cursor()
+    print("got cursor")
+
+    studies = get_study_data(cursor, study_ids, args.study_type)
+    pprint.pprint(studies)
+
+    with SymlinkStager(assembly_dir, threads=args.link_threads,) as stager:
+        assemblies = get_assemblies(
+            connection, study_ids, args.spire_version, assembly_dir, stager,
+            assembly_source=args.assembly_source, itersize=args.itersize,
+        )
+        write_studies(studies, assemblies, output_format=args.output_format,)
 
 
 if __name__ == "__main__":
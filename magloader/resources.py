@@ -0,0 +1,201 @@
+import os
+import pathlib
+import re
+import time
+
+from dataclasses import dataclass, field
+
+from .metrics import get_percentile
+
+
+MEMORY_RE = re.compile(r"^([0-9]+(?:\.[0-9]+)?)([kmgt]?)b?$", re.IGNORECASE)
+MEMORY_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def parse_memory(memory):
+    # java-style sizes, e.g. 512m, 4g, 4G
+    match = MEMORY_RE.match(str(memory).strip())
+    if not match:
+        raise ValueError(f"Cannot parse memory size {memory}.")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()])
+
+
+def get_meminfo():
+    # (MemTotal, MemAvailable) in bytes, None if /proc is not available
+    try:
+        with open("/proc/meminfo", "rt") as _in:
+            meminfo = dict(line.split(":", 1) for line in _in)
+    except OSError:
+        return None
+    return tuple(int(meminfo[key].split()[0]) * 1024 for key in ("MemTotal", "MemAvailable"))
+
+
+def get_cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_descendants_rss(root_pid=None):
+    # summed resident memory of all processes below root_pid, i.e. the webin-cli JVMs
+    # started by our worker threads (or by the workers of a process pool)
+    root_pid = root_pid or os.getpid()
+    children, rss = {}, {}
+    for proc_dir in pathlib.Path("/proc").glob("[0-9]*"):
+        try:
+            stat = (proc_dir / "stat").read_text()
+            statm = (proc_dir / "statm").read_text()
+        except OSError:
+            # process has exited in the meantime
+            continue
+        pid = int(proc_dir.name)
+        # comm can contain spaces and brackets, ppid is the second field after it
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(pid)
+        rss[pid] = int(statm.split()[1]) * PAGE_SIZE
+
+    total, n_processes, stack = 0, 0, list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        total += rss.get(pid, 0)
+        n_processes += 1
+        stack += children.get(pid, [])
+    return total, n_processes
+
+
+@dataclass
+class NodeStatus:
+    mem_total: int = None
+    mem_available: int = None
+    load: float = None
+    n_cpus: int = None
+    workers_rss: int = 0
+
+
+def get_node_status():
+    meminfo = get_meminfo()
+    if meminfo is None:
+        return None
+    workers_rss, _ = get_descendants_rss()
+    return NodeStatus(
+        mem_total=meminfo[0],
+        mem_available=meminfo[1],
+        load=os.getloadavg()[0],
+        n_cpus=get_cpu_count(),
+        workers_rss=workers_rss,
+    )
+
+
+class AdaptiveScheduler:
+    """Grows/shrinks the number of concurrent webin-cli runs between min_workers and max_workers.
+
+    A worker is added while the node has room for one more worker footprint (the largest
+    per-worker RSS seen so far, at least worker_memory) on top of mem_reserve and the load
+    is below the cpu count; a worker is removed when available memory drops below the reserve
+    or the load exceeds load_factor * cpus. Running webin-cli processes are never killed,
+    a lower limit only holds back new ones.
+    """
+    def __init__(self, min_workers=1, max_workers=None, worker_memory="2g", mem_reserve="2g", load_factor=1.5, interval=5.0, get_status=get_node_status,):
+        self.max_workers = max_workers or get_cpu_count()
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.worker_memory = parse_memory(worker_memory)
+        self.mem_reserve = parse_memory(mem_reserve)
+        self.load_factor = load_factor
+        self.interval = interval
+        self.get_status = get_status
+        self.limit = self.min_workers
+        self.worker_footprint = self.worker_memory
+        self.last_update = None
+
+    def update(self, n_running):
+        now = time.monotonic()
+        if self.last_update is not None and now - self.last_update < self.interval:
+            return None
+        self.last_update = now
+
+        status = self.get_status()
+        if status is None:
+            # no /proc, stay at the current limit
+            return None
+
+        if n_running:
+            self.worker_footprint = max(self.worker_footprint, status.workers_rss // n_running)
+
+        # running JVMs that have not reached their full footprint yet will still take memory
+        headroom = status.mem_available - self.mem_reserve - max(0, n_running * self.worker_footprint - status.workers_rss)
+        if headroom < 0 or status.load > self.load_factor * status.n_cpus:
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif n_running >= self.limit and headroom > self.worker_footprint and status.load < status.n_cpus:
+            # only grow when the current workers are all busy, one worker per interval,
+            # so that the new JVM's footprint is visible before the next decision
+            self.limit = min(self.max_workers, self.limit + 1)
+
+        return status
+
+
+# heap given to the single retry after an OutOfMemoryError, relative to the failed attempt
+HEAP_RETRY_FACTOR = 2.0
+# base/per_gb are only raised from this many assemblies' successful runs, to this percentile of the heaps they needed
+HEAP_LEARN_MIN_RUNS = 5
+HEAP_LEARN_PERCENTILE = 0.5
+
+
+def format_heap(heap):
+    # -Xmx value in whole megabytes
+    return f"{max(1, -(-heap // MEMORY_UNITS['m']))}m"
+
+
+@dataclass
+class HeapModel:
+    """-Xmx per assembly: the larger of base and per_gb per GB of compressed fasta, at most ceiling (all in bytes).
+
+    Assemblies that have run out of memory before start at twice their last failed heap (assembly_heaps).
+    """
+    base: int = 1 << 30
+    per_gb: int = 2 << 30
+    ceiling: int = 16 << 30
+    assembly_heaps: dict = field(default_factory=dict, repr=False)
+
+    def get_heap(self, fasta_size, assembly_name=None,):
+        heap = min(self.ceiling, max(self.base, int(self.per_gb * fasta_size / (1 << 30))))
+        return max(heap, self.assembly_heaps.get(assembly_name, 0))
+
+    def get_retry_heap(self, heap):
+        return min(self.ceiling, int(HEAP_RETRY_FACTOR * heap))
+
+    def learn(self, heap_runs):
+        # (assembly_name, fasta_size, heap, oom) rows from the state store, oldest first;
+        # out-of-memory runs only raise the heap of their own assembly, base/per_gb follow the heaps
+        # that the assemblies' last successful runs needed, so a single outlier does not size all others
+        succeeded = {}
+        for assembly_name, fasta_size, heap, oom in heap_runs:
+            if oom:
+                self.assembly_heaps[assembly_name] = max(self.assembly_heaps.get(assembly_name, 0), self.get_retry_heap(heap))
+            else:
+                succeeded[assembly_name] = fasta_size, heap
+
+        base_heaps, per_gb_heaps = [], []
+        for fasta_size, heap in succeeded.values():
+            if self.per_gb * fasta_size / (1 << 30) <= self.base:
+                base_heaps.append(heap)
+            else:
+                per_gb_heaps.append(heap * (1 << 30) / fasta_size)
+        if len(base_heaps) >= HEAP_LEARN_MIN_RUNS:
+            self.base = max(self.base, min(self.ceiling, get_percentile(base_heaps, HEAP_LEARN_PERCENTILE)))
+        if len(per_gb_heaps) >= HEAP_LEARN_MIN_RUNS:
+            self.per_gb = max(self.per_gb, int(get_percentile(per_gb_heaps, HEAP_LEARN_PERCENTILE)))
+        return self
+
+
+@dataclass
+class TimeoutModel:
+    """Watchdog timeout per webin-cli run: base plus per_gb per GB of compressed fasta, at most ceiling (all in seconds)."""
+    base: float = 1800.0
+    per_gb: float = 3600.0
+    ceiling: float = 86400.0
+
+    def get_timeout(self, fasta_size):
+        return min(self.ceiling, self.base + self.per_gb * fasta_size / (1 << 30))
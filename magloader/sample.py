@@ -1,9 +1,15 @@
+import copy
+import functools
+import hashlib
 import re
 
 from dataclasses import dataclass
+from xml.sax.saxutils import quoteattr, escape
 
 import lxml.builder
+import lxml.etree
 
+from .slots import intern, slotted
 from .submission import SubmissionResponseObject
 
 
@@ -11,14 +17,54 @@ DESCRIPTION = "SPIRE v01 sample. This is a virtual sample, derived from {sample_
 
 TITLE = "SPIRE v01 sample spire_sample_{sample_id}."
 
+# <ERROR>In sample, alias: "spire_sample_98834". The object being added already exists in the submission account with accession: "ERS25233782".</ERROR>
+ALREADY_EXISTS_RE = re.compile(
+    r'In sample, alias: "(.+)"\. The object being added already exists in the submission account with accession: "(.+)"\.'
+)
+
+# sample link prefix -> database
+LINK_DATABASES = {
+    "SAM": "BIOSAMPLE",
+    "mgp": "MG-RAST",
+}
+
+
+class SampleXml:
+    # tag factories shared by all samples
+    maker = lxml.builder.ElementMaker()
+
+    sample_set = maker.SAMPLE_SET
+    sample = maker.SAMPLE
+    title = maker.TITLE
+    sample_name = maker.SAMPLE_NAME
+    taxon_id = maker.TAXON_ID
+    description = maker.DESCRIPTION
+    sample_links = maker.SAMPLE_LINKS
+    sample_link = maker.SAMPLE_LINK
+    xref_link = maker.XREF_LINK
+    db = maker.DB
+    id_ = maker.ID
+    sample_attributes = maker.SAMPLE_ATTRIBUTES
+    sample_attribute = maker.SAMPLE_ATTRIBUTE
+    tag = maker.TAG
+    value = maker.VALUE
+
+
+# identical for all samples, copied into each sample
+SAMPLE_ATTRIBUTES = SampleXml.sample_attributes(
+    SampleXml.sample_attribute(
+        SampleXml.tag("collection date"), SampleXml.value("missing: third party data",)
+    ),
+    SampleXml.sample_attribute(
+        SampleXml.tag("geographic location (country and/or sea)"), SampleXml.value("missing: third party data",)
+    ),
+)
+
 class SampleSet:
     def __init__(self):
         self.samples = []
     def toxml(self):
-        maker = lxml.builder.ElementMaker()
-        sample_set = maker.SAMPLE_SET
-
-        doc = sample_set(
+        doc = SampleXml.sample_set(
             *(
                 sample.toxml()
                 for sample in self.samples
@@ -30,12 +76,44 @@ class SampleSet:
     def get_base(self):
         return self.__class__
 
+    def get_aliases(self):
+        return {sample.get_alias() for sample in self.samples}
+
+    def get_key(self):
+        # identifies the set by its samples, independent of how the input was chunked
+        return hashlib.sha1("\n".join(sorted(self.get_aliases())).encode()).hexdigest()[:16]
+
+    def write_xml(self, xml_file):
+        with lxml.etree.xmlfile(str(xml_file), encoding="UTF-8",) as xf:
+            xf.write_declaration()
+            with xf.element("SAMPLE_SET"):
+                xf.write("\n")
+                for sample in self.samples:
+                    xf.write(sample.toxml(), pretty_print=True,)
+
+    def chunks(self, chunk_size=None, max_bytes=None,):
+        chunk, chunk_bytes = SampleSet(), 0
+        for sample in self.samples:
+            # the xml is only built once, when the chunk is written
+            sample_bytes = sample.get_xml_size() if max_bytes else 0
+            if chunk.samples and (
+                (chunk_size and len(chunk.samples) >= chunk_size) or
+                (max_bytes and chunk_bytes + sample_bytes > max_bytes)
+            ):
+                yield chunk
+                chunk, chunk_bytes = SampleSet(), 0
+            chunk.samples.append(sample)
+            chunk_bytes += sample_bytes
+        if chunk.samples:
+            yield chunk
+
     @staticmethod
-    def parse_submission_response(response):
-        yield from Sample.parse_submission_response(response)
+    def parse_submission_response(objects, messages):
+        yield from Sample.parse_submission_response(objects, messages)
 
 
 
+@slotted
 @dataclass
 class Sample:
     # spire_ena_project_id	sample_id	assembly_name	assembly_type	program	description	file_path
@@ -46,7 +124,7 @@ class Sample:
 
     def __post_init__(self):
         # self.biosamples = self.description.split(" ")[-1].strip(".")
-        ...
+        self.spire_ena_project_id = intern(self.spire_ena_project_id)
 
     def get_description(self):
         return DESCRIPTION.format(sample_list=self.biosamples)
@@ -54,114 +132,123 @@ class Sample:
     def get_title(self):
         return TITLE.format(sample_id=self.sample_id)
 
+    def get_alias(self):
+        return f"spire_sample_{self.sample_id}"
+
     def get_biosamples(self):
         yield from self.biosamples.strip().split(";")
 
     def get_taxon_id(self):
         return "256318"
 
+    def get_links(self):
+        # single pass over the biosamples, biosample links are listed before mg-rast links
+        links = {db: [] for db in LINK_DATABASES.values()}
+        for biosample in self.get_biosamples():
+            db = LINK_DATABASES.get(biosample[:3])
+            if db is not None:
+                links[db].append(biosample)
+        for db, ids in links.items():
+            for id_ in ids:
+                yield db, id_
+        yield "BIOPROJECT", self.spire_ena_project_id
+
     def toxml(self):
-        maker = lxml.builder.ElementMaker()
-
-        # sample_set = maker.SAMPLE_SET
-        sample = maker.SAMPLE
-        title = maker.TITLE
-        sample_name = maker.SAMPLE_NAME
-        taxon_id = maker.TAXON_ID
-        description = maker.DESCRIPTION
-        sample_links = maker.SAMPLE_LINKS
-        sample_link = maker.SAMPLE_LINK
-        xref_link = maker.XREF_LINK
-        db = maker.DB
-        id_ = maker.ID
-        sample_attributes = maker.SAMPLE_ATTRIBUTES
-        sample_attribute = maker.SAMPLE_ATTRIBUTE
-        tag = maker.TAG
-        value = maker.VALUE
-
-        attributes = [
-            sample_attribute(
-                tag("collection date"), value("missing: third party data",)
-            ),
-            sample_attribute(
-                tag("geographic location (country and/or sea)"), value("missing: third party data",)
-            ),
-        ]
+        x = SampleXml
 
-        doc = sample(
-            title(self.get_title()),
-            sample_name(
-                taxon_id(self.get_taxon_id()),
+        doc = x.sample(
+            x.title(self.get_title()),
+            x.sample_name(
+                x.taxon_id(self.get_taxon_id()),
             ),
-            description(self.get_description()),
-            sample_links(
-                *(
-                    sample_link(
-                        xref_link(
-                            db("BIOSAMPLE"), id_(bs)
-                        )
-                    )
-                    for bs in self.get_biosamples()
-                    if bs[:3] == "SAM"
-                ),
+            x.description(self.get_description()),
+            x.sample_links(
                 *(
-                    sample_link(
-                        xref_link(
-                            db("MG-RAST"), id_(mgs)
+                    x.sample_link(
+                        x.xref_link(
+                            x.db(db), x.id_(id_)
                         )
                     )
-                    for mgs in self.get_biosamples()
-                    if mgs[:3] == "mgp"
+                    for db, id_ in self.get_links()
                 ),
-                sample_link(
-                    xref_link(
-                        db("BIOPROJECT"), id_(self.spire_ena_project_id)
-                    )
-                ),
-            ),
-            sample_attributes(
-                *attributes
             ),
-            alias=f"spire_sample_{self.sample_id}",
+            copy.deepcopy(SAMPLE_ATTRIBUTES),
+            alias=self.get_alias(),
         )
 
         return doc
 
+    def get_xml_size(self):
+        # size of the pretty-printed, UTF-8 encoded toxml() without building it
+        fixed_size, link_size = get_sample_xml_overhead()
+        links = list(self.get_links())
+        return (
+            fixed_size + link_size * len(links) +
+            sum(get_text_size(text) for text in (self.get_title(), self.get_taxon_id(), self.get_description(),)) +
+            sum(get_text_size(db) + get_text_size(id_) for db, id_ in links) +
+            len(quoteattr(self.get_alias()).encode())
+        )
+
     @staticmethod
-    def parse_submission_response(response):
+    def parse_submission_response(objects, messages):
 
         failed_samples = {}
 
-        for sample in response.findall("SAMPLE"):
+        for tag, attrib, ext_accession in objects:
+            if tag != "SAMPLE":
+                continue
 
             d = {
                 "object_type": "sample",
-                "alias": sample.attrib.get("alias"),
-                "status": sample.attrib.get("status"),
-                "hold_until": sample.attrib.get("holdUntilDate"),
-                "accession": sample.attrib.get("accession"),
+                "alias": attrib.get("alias"),
+                "status": attrib.get("status"),
+                "hold_until": attrib.get("holdUntilDate"),
+                "accession": attrib.get("accession"),
+                "ext_accession": ext_accession,
             }
 
-            ext_id = sample.find("EXT_ID")
-            d["ext_accession"] = ext_id.attrib.get("accession") if ext_id is not None else None
-
             if d["accession"] is None:
                 failed_samples[d["alias"]] = d
             else:
                 yield SubmissionResponseObject(**d)
 
         if failed_samples:
-            messages = response.find("MESSAGES")
-            if messages is not None:
-                for msg in messages.getchildren():
-                    # <ERROR>In sample, alias: "spire_sample_98834". The object being added already exists in the submission account with accession: "ERS25233782".</ERROR>
-                    match = re.search(
-                        r'In sample, alias: "(.+)"\. The object being added already exists in the submission account with accession: "(.+)"\.',
-                        msg.text
-                    )
-                    if match:
-                        alias, accession = match.group(1), match.group(2)
-                        d = failed_samples.get(alias)
-                        if d is not None:
-                            d["accession"] = accession
-                            yield SubmissionResponseObject(**d)
+            existing = get_existing_accessions(messages)
+            for alias, d in failed_samples.items():
+                accession = existing.get(alias)
+                if accession is not None:
+                    d["accession"] = accession
+                    d["recovered"] = True
+                    yield SubmissionResponseObject(**d)
+
+
+def get_text_size(text):
+    # empty elements serialise as <TAG/>, which is shorter than counted here
+    return len(escape(str(text or "")).encode())
+
+
+@functools.lru_cache(maxsize=None)
+def get_sample_xml_overhead():
+    # (markup bytes per sample, markup bytes per sample link), measured once on two reference samples
+    def get_markup_size(sample):
+        return len(lxml.etree.tostring(sample.toxml(), pretty_print=True, encoding="UTF-8",)) - sum(
+            get_text_size(text) for text in (sample.get_title(), sample.get_taxon_id(), sample.get_description(),)
+        ) - sum(
+            get_text_size(db) + get_text_size(id_) for db, id_ in sample.get_links()
+        ) - len(quoteattr(sample.get_alias()).encode())
+
+    one_link = get_markup_size(Sample(spire_ena_project_id="PRJEB1", sample_id="1", biosamples="SAMEA1",))
+    two_links = get_markup_size(Sample(spire_ena_project_id="PRJEB1", sample_id="1", biosamples="SAMEA1;SAMEA2",))
+    link_size = two_links - one_link
+    # both reference samples also link the bioproject
+    return one_link - 2 * link_size, link_size
+
+
+def get_existing_accessions(messages):
+    # alias -> accession index over the "already exists" errors of a receipt
+    existing = {}
+    for _, text in messages:
+        match = ALREADY_EXISTS_RE.search(text or "")
+        if match:
+            existing[match.group(1)] = match.group(2)
+    return existing
@@ -0,0 +1,22 @@
+import dataclasses
+import sys
+
+
+def slotted(cls):
+    # equivalent of @dataclass(slots=True), which is only available from python 3.10
+    # the class is re-created with __slots__ instead of a per-instance __dict__
+    # (the generated __init__ keeps the field defaults, so the class attributes can go)
+    field_names = tuple(f.name for f in dataclasses.fields(cls))
+    cls_dict = {k: v for k, v in cls.__dict__.items() if k not in field_names + ("__dict__", "__weakref__",)}
+    cls_dict["__slots__"] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+
+def as_dict(obj):
+    # shallow replacement for obj.__dict__ that also works for slotted dataclasses
+    return {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+
+
+def intern(s):
+    # de-duplicates strings that repeat across many objects (program, project ids, ...)
+    return sys.intern(s) if isinstance(s, str) else s
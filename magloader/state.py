@@ -0,0 +1,169 @@
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+STATE_DB = "magloader.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registrations (
+    key TEXT PRIMARY KEY,
+    obj_type TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    obj_type TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    accession TEXT,
+    ext_accession TEXT,
+    status TEXT,
+    hold_until TEXT,
+    PRIMARY KEY (obj_type, alias)
+);
+CREATE TABLE IF NOT EXISTS assemblies (
+    assembly_name TEXT PRIMARY KEY,
+    manifest TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'prepared',
+    accession TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    messages TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assemblies_status ON assemblies (status);
+CREATE TABLE IF NOT EXISTS heap_runs (
+    assembly_name TEXT NOT NULL,
+    fasta_size INTEGER NOT NULL,
+    heap INTEGER NOT NULL,
+    oom INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    n_done INTEGER,
+    n_failed INTEGER
+);
+"""
+
+
+class StateStore:
+    """Keeps receipts, accessions and assembly status of a workdir in one sqlite database."""
+    def __init__(self, workdir):
+        self.workdir = pathlib.Path(workdir).absolute()
+        # shared between threads, access is serialised via self.lock
+        self.connection = sqlite3.connect(self.workdir / STATE_DB, check_same_thread=False,)
+        self.lock = threading.RLock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_key(self, path):
+        return os.path.relpath(pathlib.Path(path).absolute(), self.workdir)
+
+    def get_response(self, path):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response FROM registrations WHERE key = ?", (self.get_key(path),)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def set_response(self, path, obj_type, response):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO registrations (key, obj_type, response, created) VALUES (?, ?, ?, ?)",
+                (self.get_key(path), obj_type, response.to_json(), time.time(),),
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO objects (obj_type, alias, accession, ext_accession, status, hold_until) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (obj_type, obj.alias, obj.accession, obj.ext_accession, obj.status, obj.hold_until,)
+                    for obj in response.objects
+                ),
+            )
+
+    def get_done_assemblies(self):
+        with self.lock:
+            return {
+                assembly_name
+                for assembly_name, in self.connection.execute(
+                    "SELECT assembly_name FROM assemblies WHERE status = 'done'"
+                )
+            }
+
+    def get_accessions(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT accession, manifest FROM assemblies WHERE status = 'done' AND accession IS NOT NULL ORDER BY updated"
+            ).fetchall()
+
+    def add_manifests(self, manifests):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO assemblies (assembly_name, manifest, created, updated) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (assembly_name) DO UPDATE SET manifest = excluded.manifest",
+                ((get_assembly_name(manifest), str(pathlib.Path(manifest).absolute()), now, now,) for manifest in manifests),
+            )
+
+    def set_assembly_status(self, manifest, status, accession=None, messages=None, attempt=True,):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE assemblies SET status = ?, accession = COALESCE(?, accession), messages = ?, "
+                "attempts = attempts + ?, updated = ? WHERE assembly_name = ?",
+                (status, accession, json.dumps(messages) if messages else None, int(attempt), time.time(), get_assembly_name(manifest),),
+            )
+
+    def add_heap_runs(self, manifest, heap_runs):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO heap_runs (assembly_name, fasta_size, heap, oom, created) VALUES (?, ?, ?, ?, ?)",
+                ((get_assembly_name(manifest), fasta_size, heap, int(oom), now,) for fasta_size, heap, oom in heap_runs),
+            )
+
+    def get_heap_runs(self):
+        with self.lock:
+            return self.connection.execute("SELECT assembly_name, fasta_size, heap, oom FROM heap_runs ORDER BY rowid").fetchall()
+
+    def get_status_counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM assemblies GROUP BY status ORDER BY status"))
+
+    def get_runs(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT run_id, started, finished, n_done, n_failed FROM runs ORDER BY run_id"
+            ).fetchall()
+
+    def start_run(self):
+        with self.lock, self.connection:
+            return self.connection.execute("INSERT INTO runs (started) VALUES (?)", (time.time(),)).lastrowid
+
+    def finish_run(self, run_id, n_done, n_failed):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE runs SET finished = ?, n_done = ?, n_failed = ? WHERE run_id = ?",
+                (time.time(), n_done, n_failed, run_id,),
+            )
+
+
+def get_assembly_name(manifest):
+    # manifests live in <workdir>/assemblies/<assembly_name>/
+    return pathlib.Path(manifest).parent.name
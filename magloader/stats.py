@@ -0,0 +1,59 @@
+import argparse
+import pathlib
+import time
+
+from .metrics import get_run_stats, read_metrics, write_prometheus, METRICS_FILE
+from .state import StateStore, STATE_DB
+
+
+def get_state_dirs(workdir):
+    # single-study workdir, or a batch workdir with one state store per study
+    if (workdir / STATE_DB).is_file():
+        yield workdir
+    yield from sorted(path.parent for path in workdir.glob(f"*/{STATE_DB}"))
+
+
+def print_state(state_dir):
+    with StateStore(state_dir) as state:
+        counts = state.get_status_counts()
+        print(f"{state_dir}: " + (", ".join(f"{n} {status}" for status, n in counts.items()) or "no assemblies"))
+        for run_id, started, finished, n_done, n_failed in state.get_runs():
+            started_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))
+            if finished is None:
+                print(f"  run {run_id}: {started_str}, not finished")
+            else:
+                minutes = (finished - started) / 60.0
+                print(
+                    f"  run {run_id}: {started_str}, {minutes:.1f}min, {n_done} done, {n_failed} failed"
+                    f"{f', {n_done / minutes:.2f}/min' if minutes else ''}"
+                )
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="magloader stats")
+    ap.add_argument("workdir", type=str)
+    ap.add_argument("--last", type=int, default=None,)  # only summarise the last n runs from the metrics file
+    ap.add_argument("--prometheus_textfile", type=str, default=None,)  # export the latest run
+
+    args = ap.parse_args(argv)
+
+    workdir = pathlib.Path(args.workdir)
+    if not workdir.is_dir():
+        raise ValueError(f"{workdir} is not a directory.")
+
+    for state_dir in get_state_dirs(workdir):
+        print_state(state_dir)
+
+    metrics_file = workdir / METRICS_FILE
+    if not metrics_file.is_file():
+        print(f"No metrics in {workdir}.")
+        return None
+
+    runs = sorted(get_run_stats(read_metrics(metrics_file)).values(), key=lambda run: run.started,)
+    for run in runs[-args.last if args.last else 0:]:
+        print(run.summary())
+
+    if args.prometheus_textfile and runs:
+        write_prometheus(runs[-1], args.prometheus_textfile)
+
+    return None
@@ -10,6 +10,30 @@ from .submission import SubmissionResponseObject
 
 
 
+class StudyXml:
+    # tag factories shared by all studies
+    maker = lxml.builder.ElementMaker()
+
+    study_set = maker.STUDY_SET
+    study = maker.STUDY
+    descriptor = maker.DESCRIPTOR
+    study_title = maker.STUDY_TITLE
+    study_type = maker.STUDY_TYPE
+    study_description = maker.STUDY_DESCRIPTION
+    study_links = maker.STUDY_LINKS
+    study_link = maker.STUDY_LINK
+    url_link = maker.URL_LINK
+    label = maker.LABEL
+    url = maker.URL
+    xref_link = maker.XREF_LINK
+    db = maker.DB
+    id_ = maker.ID
+    study_attributes = maker.STUDY_ATTRIBUTES
+    study_attribute = maker.STUDY_ATTRIBUTE
+    tag = maker.TAG
+    value = maker.VALUE
+
+
 class Study(ABC):
     def __init__(
         self,
@@ -43,18 +67,18 @@ class Study(ABC):
         yield from self.raw_data_projects.strip().split(",")
     
     @staticmethod
-    def parse_submission_response(response):
-        study = response.find("STUDY")
-        if study is not None:
-            ext_id = study.find("EXT_ID")
-            yield SubmissionResponseObject(
-                object_type="study",
-                alias=study.attrib.get("alias"),
-                status=study.attrib.get("status"),
-                hold_until=study.attrib.get("holdUntilDate"),
-                accession=study.attrib.get("accession"),
-                ext_accession=ext_id.attrib.get("accession") if ext_id is not None else None,
-            )
+    def parse_submission_response(objects, messages):
+        for tag, attrib, ext_accession in objects:
+            if tag == "STUDY":
+                yield SubmissionResponseObject(
+                    object_type="study",
+                    alias=attrib.get("alias"),
+                    status=attrib.get("status"),
+                    hold_until=attrib.get("holdUntilDate"),
+                    accession=attrib.get("accession"),
+                    ext_accession=ext_accession,
+                )
+                break
 
 class SpireStudy(Study):
     def __init__(
@@ -79,58 +103,39 @@ class SpireStudy(Study):
         )
 
     def toxml(self):
-        maker = lxml.builder.ElementMaker()
-
-        study_set = maker.STUDY_SET
-        study = maker.STUDY
-        descriptor = maker.DESCRIPTOR
-        study_title = maker.STUDY_TITLE
-        study_type = maker.STUDY_TYPE
-        study_description = maker.STUDY_DESCRIPTION
-        study_links = maker.STUDY_LINKS
-        study_link = maker.STUDY_LINK
-        url_link = maker.URL_LINK
-        label = maker.LABEL
-        url = maker.URL
-        xref_link = maker.XREF_LINK
-        db = maker.DB
-        id_ = maker.ID
-        study_attributes = maker.STUDY_ATTRIBUTES
-        study_attribute = maker.STUDY_ATTRIBUTE
-        tag = maker.TAG
-        value = maker.VALUE
-
-        doc = study_set(
-            study(
-                descriptor(
-                    study_title(self.get_title()),
-                    study_type(
+        x = StudyXml
+
+        doc = x.study_set(
+            x.study(
+                x.descriptor(
+                    x.study_title(self.get_title()),
+                    x.study_type(
                         existing_study_type="Other",
                         new_study_type=self.new_study_type,),
-                    study_description(self.get_description()),
+                    x.study_description(self.get_description()),
                 ),
-                study_links(
-                    study_link(
-                        url_link(
-                            label("SPIRE"),
-                            url(self.get_spire_link()),
+                x.study_links(
+                    x.study_link(
+                        x.url_link(
+                            x.label("SPIRE"),
+                            x.url(self.get_spire_link()),
                         )
                     ),
                     *(
-                        study_link(
-                            xref_link(
-                                db("BIOPROJECT"),
-                                id_(xid),
+                        x.study_link(
+                            x.xref_link(
+                                x.db("BIOPROJECT"),
+                                x.id_(xid),
                             )
                         )
                         for xid in self.get_raw_data_projects()
                         if xid[:3] == "PRJ"
                     ),
                 ),
-                study_attributes(
-                    study_attribute(
-                        tag("study keyword"),
-                        value(self.study_keyword),
+                x.study_attributes(
+                    x.study_attribute(
+                        x.tag("study keyword"),
+                        x.value(self.study_keyword),
                     )
                 ),
                 alias=f"spire_study_{self.study_id}",
@@ -1,13 +1,25 @@
+import contextlib
 import copy
+import io
 import json
+import pathlib
+import random
 import requests
+import requests.adapters
+import shutil
+import tempfile
+import time
+import uuid
 
 from dataclasses import dataclass, field
-from io import StringIO
 
 import lxml.etree, lxml.builder
 
+from .metrics import NO_METRICS
+from .slots import as_dict, intern, slotted
 
+
+@slotted
 @dataclass
 class SubmissionResponseObject:
     alias: str = None
@@ -16,6 +28,13 @@ class SubmissionResponseObject:
     ext_accession: str = None
     status: str = None
     hold_until: str = None
+    # accession taken from an "already exists" message of a failed submission
+    recovered: bool = False
+
+    def __post_init__(self):
+        self.object_type = intern(self.object_type)
+        self.status = intern(self.status)
+        self.hold_until = intern(self.hold_until)
 
 
 @dataclass
@@ -45,30 +64,53 @@ class SubmissionResponse:
 
     @classmethod
     def from_xml(cls, xml, obj_type):
-        # xml = "\n".join(line for line in xml.text.strip().split("\n") if line[:5] != "<?xml")
-
-        tree = lxml.etree.fromstring(xml)
-
-        d = {
-            "success": tree.attrib.get("success", "false").lower() != "false",
-            "receipt_date": tree.attrib.get("receiptDate"),
-            "objects": list(obj_type.parse_submission_response(tree)),
-        }
-
-        submission = tree.find("SUBMISSION")
-        if submission is not None:
-            d["submission_accession"] = submission.attrib.get("accession")
-            d["submission_alias"] = submission.attrib.get("alias")
-
-        messages = tree.find("MESSAGES")
-        if messages is not None:
-            d["messages"] = [(m.tag, m.text) for m in messages.getchildren()]
+        # the receipt is parsed incrementally: each top-level element is handed on
+        # as a lightweight tuple and cleared, so large receipts never exist as a full tree
+        if isinstance(xml, str):
+            xml = xml.encode()
+
+        d, messages = {}, []
+
+        def iter_objects():
+            depth = 0
+            for event, element in lxml.etree.iterparse(io.BytesIO(xml), events=("start", "end",)):
+                if event == "start":
+                    if depth == 0:
+                        d["success"] = element.attrib.get("success", "false").lower() != "false"
+                        d["receipt_date"] = element.attrib.get("receiptDate")
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                if element.tag == "SUBMISSION":
+                    d["submission_accession"] = element.attrib.get("accession")
+                    d["submission_alias"] = element.attrib.get("alias")
+                elif element.tag == "MESSAGES":
+                    messages.extend((m.tag, m.text) for m in element)
+                    d["messages"] = messages
+                elif element.tag != "ACTIONS":
+                    ext_id = element.find("EXT_ID")
+                    yield element.tag, dict(element.attrib), (ext_id.attrib.get("accession") if ext_id is not None else None)
+
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        objects = iter_objects()
+        # messages follow the objects in the receipt, so they are only
+        # filled in once a parser has exhausted the objects
+        d["objects"] = list(obj_type.parse_submission_response(objects, messages))
+        for _ in objects:
+            pass
 
         return cls(**d)
 
     def to_json(self):
         d = copy.deepcopy(self.__dict__)
-        d['objects'] = [o.__dict__ for o in d['objects']]
+        d['objects'] = [as_dict(o) for o in d['objects']]
 
         return json.dumps(d)
 
@@ -79,52 +121,113 @@ class SubmissionResponse:
         return obj
 
 
+MULTIPART_SPOOL_SIZE = 1 << 24
+
+
+def get_session(pool_size=10):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@contextlib.contextmanager
+def get_multipart_body(files, max_size=MULTIPART_SPOOL_SIZE,):
+    # streams the files into a (spooled) multipart/form-data body,
+    # so large xml documents are never held in memory as a whole
+    boundary = uuid.uuid4().hex
+    with tempfile.SpooledTemporaryFile(max_size=max_size) as body:
+        for name, path in files.items():
+            body.write(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}"\r\n\r\n'.encode()
+            )
+            with open(path, "rb") as _in:
+                shutil.copyfileobj(_in, body)
+            body.write(b"\r\n")
+        body.write(f"--{boundary}--\r\n".encode())
+        yield body, f"multipart/form-data; boundary={boundary}"
+
+
 class Submission:
-    def __init__(self, user, pw, hold_date=None, dev=True, timeout=60):
+    def __init__(self, user, pw, hold_date=None, dev=True, timeout=60, session=None, retries=3, backoff=2.0, max_backoff=60.0, url=None, metrics=None,):
         self.user = user
         self.pw = pw
         self.hold_date = hold_date
         self.dev = dev
         self.timeout = timeout
+        self.session = session or get_session()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.url = url
+        self.metrics = metrics or NO_METRICS
 
     def get_auth(self):
         return self.user, self.pw
 
-    def submit(self, obj):
+    def get_url(self):
+        return self.url or f"https://www{('', 'dev')[self.dev]}.ebi.ac.uk/ena/submit/drop-box/submit/"
+
+    def post(self, url, files):
+        # retries timeouts, connection errors and 5xx responses with exponential backoff and full jitter
+        with get_multipart_body(files) as (body, content_type):
+            for attempt in range(self.retries + 1):
+                body.seek(0)
+                try:
+                    with self.metrics.timed("http_seconds", attempt=attempt, status=None,) as labels:
+                        response = self.session.post(
+                            url,
+                            data=body,
+                            headers={"Content-Type": content_type},
+                            auth=self.get_auth(),
+                            timeout=self.timeout,
+                        )
+                        labels["status"] = response.status_code
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    if attempt == self.retries:
+                        raise
+                    print(f"Submission attempt {attempt + 1} failed: {err}")
+                else:
+                    if response.status_code < 500 or attempt == self.retries:
+                        return response
+                    print(f"Submission attempt {attempt + 1} failed: HTTP {response.status_code}")
+
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def submit(self, obj, outdir=None,):
         # requests.post(url, files={"SUBMISSION": open("submission.xml", "rb"), "STUDY": open("study3.xml", "rb")}, auth=(webin, pw))
         # curl -u 'user:password' -F "SUBMISSION=@submission.xml" -F "STUDY=@study3.xml" "https://wwwdev.ebi.ac.uk/ena/submit/drop-box/submit/"
-        url = f"https://www{('', 'dev')[self.dev]}.ebi.ac.uk/ena/submit/drop-box/submit/"
+        url = self.get_url()
+
+        outdir = pathlib.Path(outdir or ".")
 
-        submission_xml = Submission.generate_submission(hold_date=self.hold_date)
-        with open("submission.xml", "wt") as _out:
-            _out.write(submission_xml)
+        submission_file = outdir / "submission.xml"
+        with open(submission_file, "wt") as _out:
+            _out.write(Submission.generate_submission(hold_date=self.hold_date))
 
-        obj_xml = obj.toxml()
         obj_base = obj.get_base()
 
-        # obj_xml = lxml.etree.tostring(obj.toxml()).decode()
-        with open(f"{obj_base.__name__.lower()}.xml", "wb") as _out:
-            _out.write(lxml.etree.tostring(obj_xml, pretty_print=True,))
+        # the object xml is built exactly once, written to disk and uploaded from there
+        obj_file = outdir / f"{obj_base.__name__.lower()}.xml"
+        if hasattr(obj, "write_xml"):
+            obj.write_xml(obj_file)
+        else:
+            with open(obj_file, "wb") as _out:
+                _out.write(lxml.etree.tostring(obj.toxml(), pretty_print=True,))
 
-        response = requests.post(
+        response = self.post(
             url,
-            files={
-                # "SUBMISSION": StringIO(Submission.generate_submission(hold_date=self.hold_date)),
-                "SUBMISSION": StringIO(submission_xml),
-                # obj.__class__.__name__.upper().replace("SET", ""): StringIO(
-                #     lxml.etree.tostring(obj.toxml()).decode()
-                # ),
-                obj_base.__name__.upper().replace("SET", ""): StringIO(lxml.etree.tostring(obj_xml).decode()),
+            {
+                "SUBMISSION": submission_file,
+                obj_base.__name__.upper().replace("SET", ""): obj_file,
             },
-            auth=self.get_auth(),
-            timeout=self.timeout,
         )
 
-        response_xml = "\n".join(line for line in response.text.strip().split("\n") if line[:5] != "<?xml")
-        with open(f"{obj_base.__name__.lower()}_ena_response.xml", "wt") as _out:
-            _out.write(response_xml)
+        with open(outdir / f"{obj_base.__name__.lower()}_ena_response.xml", "wb") as _out:
+            _out.write(response.content)
 
-        return SubmissionResponse.from_xml(response_xml, obj_base)
+        return SubmissionResponse.from_xml(response.content, obj_base)
 
 
     @staticmethod
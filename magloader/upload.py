@@ -1,10 +1,20 @@
+import heapq
+import itertools
+import json
+import math
+import os
 import pathlib
+import random
+import time
 
-from multiprocessing import Pool
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
 
 from .manifest import Manifest
-from .webin import EnaWebinClient
-from .workdir import working_directory
+from .metrics import NO_METRICS
+from .resources import format_heap
+from .webin import classify_messages, get_accession, is_out_of_memory, read_report, EnaWebinClient
 
 
 def check_assemblies(biosamples, assemblies):
@@ -14,46 +24,302 @@ def check_assemblies(biosamples, assemblies):
             raise ValueError(f"{biosample.alias} does not have an assembly!")
         yield biosample.accession, assembly
 
-def prepare_manifest_files(study_id, assemblies, workdir):
+
+@dataclass
+class Reconciliation:
+    matched: list = field(default_factory=list)
+    receipt_only: list = field(default_factory=list)
+    assembly_only: list = field(default_factory=list)
+    recovered: list = field(default_factory=list)
+
+    def __str__(self):
+        return (
+            f"{len(self.matched)} matched, {len(self.receipt_only)} receipt-only, "
+            f"{len(self.assembly_only)} assembly-only, {len(self.recovered)} recovered from existing records"
+        )
+
+    def write(self, report_file):
+        with open(report_file, "wt", encoding="UTF-8",) as _out:
+            for biosample in self.recovered:
+                print("recovered", biosample.alias, biosample.accession, sep="\t", file=_out,)
+            for biosample in self.receipt_only:
+                print("receipt_only", biosample.alias, biosample.accession, sep="\t", file=_out,)
+            for alias in self.assembly_only:
+                print("assembly_only", alias, "", sep="\t", file=_out,)
+
+
+def reconcile_assemblies(biosamples, assemblies):
+    # unlike check_assemblies, mismatches are collected instead of aborting the run,
+    # the matched (accession, assembly) pairs can be submitted regardless
+    reconciliation = Reconciliation()
+    receipts = {biosample.alias: biosample for biosample in biosamples}
+    for alias, biosample in receipts.items():
+        assembly = assemblies.get(alias)
+        if assembly is None:
+            reconciliation.receipt_only.append(biosample)
+            continue
+        reconciliation.matched.append((biosample.accession, assembly))
+        if biosample.recovered:
+            reconciliation.recovered.append(biosample)
+    reconciliation.assembly_only += (alias for alias in assemblies if alias not in receipts)
+    return reconciliation
+
+def recover_accession(assembly_dir):
+    # accession of an assembly finished by a run without state store, from its last (submission) report
+    return get_accession(read_report(assembly_dir))
+
+
+def prepare_manifest_files(study_id, assemblies, workdir, state=None,):
+    # assemblies the state store has as done are skipped without touching the file system,
+    # for all others (unknown to the store, or finished by a run without it) the DONE sentinel decides
+    done_assemblies = state.get_done_assemblies() if state is not None else set()
+    manifest_files, legacy_done = [], []
     for biosample_accession, assembly in assemblies:
+        if assembly.assembly_name in done_assemblies:
+            continue
         assembly_dir = workdir / "assemblies" / assembly.assembly_name
-        assembly_done = assembly_dir / "DONE"
-        if not assembly_done.is_file():
-            assembly_dir.mkdir(parents=True, exist_ok=True,)
-            manifest_file = pathlib.Path(assembly_dir / f"{assembly.assembly_name}.manifest.txt")
-            if not manifest_file.is_file():
-                with open(manifest_file, "wt") as _out:
-                    manifest = Manifest.from_assembly(assembly, study_id, biosample_accession)
-                    print(manifest.to_str(), file=_out,)
-                print(manifest)
-            yield manifest_file
-                
-def process_manifest(manifest_file, user, password, submit=True, run_on_dev_server=False, java_max_heap=None,):
-    webin_client = EnaWebinClient(user, password)
-    with working_directory(pathlib.Path(manifest_file).parent):
-        validation_sentinel = pathlib.Path("VALIDATION_DONE")
-        is_valid = validation_sentinel.is_file()
-        if not is_valid:
-            is_valid, messages = webin_client.validate(manifest_file.name, dev=run_on_dev_server, java_max_heap=java_max_heap,)
-            if is_valid:
-                validation_sentinel.touch()
-
-        if is_valid and submit:
-            ena_id, messages = webin_client.submit(manifest_file.name, dev=run_on_dev_server, java_max_heap=java_max_heap,)
-            if ena_id:
-                pathlib.Path("DONE").touch()
-                return ena_id, [], manifest_file.absolute()
-        return None, messages, None
-    
-
-def upload(manifests, upload_f, threads=1):
-    if threads == 1:
+        manifest_file = pathlib.Path(assembly_dir / f"{assembly.assembly_name}.manifest.txt")
+        if (assembly_dir / "DONE").is_file():
+            legacy_done.append(manifest_file)
+            continue
+        assembly_dir.mkdir(parents=True, exist_ok=True,)
+        if not manifest_file.is_file():
+            with open(manifest_file, "wt") as _out:
+                manifest = Manifest.from_assembly(assembly, study_id, biosample_accession)
+                print(manifest.to_str(), file=_out,)
+            print(manifest)
+        manifest_files.append(manifest_file)
+        yield manifest_file
+
+    if state is not None:
+        state.add_manifests(manifest_files + legacy_done)
+        for manifest_file in legacy_done:
+            accession = recover_accession(manifest_file.parent)
+            messages = None
+            if accession is None:
+                print(f"{manifest_file.parent.name}: DONE, but the accession is unknown (no submission report in {manifest_file.parent}).")
+                messages = [(-1, "NOREPORT", "Finished by an earlier run, accession unknown.",)]
+            state.set_assembly_status(manifest_file, "done", accession=accession, messages=messages, attempt=False,)
+
+
+# separate: always validate, then submit
+# inline: single -submit pass, webin-cli validates as part of the submission
+# skip-known-good: validate unless a previous run has left VALIDATION_DONE, then submit
+VALIDATION_MODES = ("separate", "inline", "skip-known-good",)
+
+# (fasta_size, heap, oom) per line for the webin-cli runs of all process_manifest calls since the last recorded result,
+# picked up by the state store
+HEAP_RUNS = "java_heap.jsonl"
+
+
+def get_fasta_size(manifest_file):
+    fasta = Manifest.from_file(manifest_file).fasta
+    try:
+        return os.stat(manifest_file.parent / fasta).st_size if fasta else 0
+    except OSError:
+        return 0
+
+
+def read_heap_runs(manifest_dir):
+    heap_runs_file = pathlib.Path(manifest_dir) / HEAP_RUNS
+    if not heap_runs_file.is_file():
+        return []
+    with open(heap_runs_file, "rt", encoding="UTF-8",) as _in:
+        return [json.loads(line) for line in _in if line.strip()]
+
+
+def run_webin_client(run_f, manifest_file, java_max_heap=None, heap_model=None, heap_runs=None, timeout_model=None, earlier_runs=(),):
+    # with a heap model (and no fixed java_max_heap), -Xmx is sized per assembly
+    # and a run that has run out of memory is repeated once with a larger heap;
+    # with a timeout model, the run is killed by a watchdog after a time that scales with the fasta size
+    fasta_size = get_fasta_size(manifest_file) if heap_model is not None or timeout_model is not None else 0
+    timeout = timeout_model.get_timeout(fasta_size) if timeout_model is not None else None
+    run_f = partial(run_f, cwd=manifest_file.parent, timeout=timeout,)
+
+    if java_max_heap is not None or heap_model is None:
+        return run_f(manifest_file.name, java_max_heap=java_max_heap,)
+
+    # the submit run starts with the heap the validation run ended up with,
+    # a re-queued attempt above the heaps that earlier attempts ran out of memory with
+    heap = max(
+        [heap_model.get_heap(fasta_size, assembly_name=manifest_file.parent.name)] +
+        [heap for _, heap, _ in heap_runs[-1:]] +
+        [heap_model.get_retry_heap(heap) for _, heap, oom in earlier_runs if oom]
+    )
+    result, messages = run_f(manifest_file.name, java_max_heap=format_heap(heap),)
+    oom = is_out_of_memory(messages)
+    heap_runs.append((fasta_size, heap, oom,))
+
+    if oom and heap_model.get_retry_heap(heap) > heap:
+        heap = heap_model.get_retry_heap(heap)
+        print(f"{manifest_file.name}: java.lang.OutOfMemoryError, retrying with -Xmx{format_heap(heap)}")
+        result, messages = run_f(manifest_file.name, java_max_heap=format_heap(heap),)
+        heap_runs.append((fasta_size, heap, is_out_of_memory(messages),))
+
+    return result, messages
+
+
+def process_manifest(manifest_file, user, password, submit=True, run_on_dev_server=False, java_max_heap=None, webin_cli=None, webin_cli_server=None, java_opts=None, validation_mode="skip-known-good", heap_model=None, abort_on_error=False, timeout_model=None, metrics=None,):
+    metrics = metrics or NO_METRICS
+    if validation_mode not in VALIDATION_MODES:
+        raise ValueError(f"Unknown validation mode {validation_mode}.")
+
+    webin_client = EnaWebinClient(user, password, executable=webin_cli, abort_on_error=abort_on_error, server=webin_cli_server, java_opts=java_opts,)
+    manifest_file = pathlib.Path(manifest_file).absolute()
+    manifest_dir = manifest_file.parent
+
+    validation_sentinel = manifest_dir / "VALIDATION_DONE"
+    heap_runs = []
+    run_webin = partial(
+        run_webin_client,
+        manifest_file=manifest_file, java_max_heap=java_max_heap, heap_model=heap_model, heap_runs=heap_runs, timeout_model=timeout_model,
+        earlier_runs=read_heap_runs(manifest_dir) if heap_model is not None else (),
+    )
+    is_valid, messages = validation_sentinel.is_file() and validation_mode != "separate", []
+    if not is_valid and (validation_mode != "inline" or not submit):
+        with metrics.timed("webin_seconds", action="validate", assembly=manifest_dir.name,) as labels:
+            is_valid, messages = run_webin(partial(webin_client.validate, dev=run_on_dev_server,))
+            labels["success"] = is_valid
+        if is_valid:
+            validation_sentinel.touch()
+
+    ena_id = None
+    if submit and (is_valid or validation_mode == "inline"):
+        with metrics.timed("webin_seconds", action="submit", assembly=manifest_dir.name,) as labels:
+            ena_id, messages = run_webin(partial(webin_client.submit, dev=run_on_dev_server,))
+            labels["success"] = ena_id is not None
+        if ena_id:
+            validation_sentinel.touch()
+            (manifest_dir / "DONE").touch()
+            messages = []
+
+    # appended: a re-queued manifest runs process_manifest again before its result is recorded
+    if heap_runs:
+        with open(manifest_dir / HEAP_RUNS, "at", encoding="UTF-8",) as _out:
+            print(*(json.dumps(heap_run) for heap_run in heap_runs), sep="\n", file=_out,)
+
+    return ena_id or None, messages, manifest_file
+
+
+def as_completed_bounded(executor, f, items, max_pending, metrics=None,):
+    # keeps at most max_pending tasks queued/running and yields results in completion order
+    items = iter(items)
+    pending = set()
+    while True:
+        pending.update(
+            executor.submit(f, item)
+            for item in itertools.islice(items, max(max_pending - len(pending), 0))
+        )
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        if metrics is not None:
+            metrics.emit("queue_depth", len(pending))
+        for future in done:
+            yield future.result()
+
+
+class FixedScheduler:
+    """Scheduler interface for as_completed_scheduled with a fixed limit: threads workers, max_pending tasks in flight."""
+    def __init__(self, threads=1, max_pending=None,):
+        self.max_workers = threads
+        self.limit = max_pending or 2 * threads
+        self.interval = None
+
+    def update(self, n_running):
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    """Re-queues manifests whose webin-cli run failed for a transient reason."""
+    retries: int = 2
+    backoff: float = 60.0
+    max_backoff: float = 900.0
+
+    def should_retry(self, result, attempt):
+        ena_id, messages, _ = result
+        return ena_id is None and attempt < self.retries and classify_messages(messages) == "transient"
+
+    def get_delay(self, attempt):
+        # exponential backoff with full jitter, as for the drop-box submissions
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+def as_completed_scheduled(executor, f, items, scheduler, retry_policy=None, metrics=None,):
+    # like as_completed_bounded, but the number of tasks in flight follows scheduler.limit,
+    # which is re-evaluated at least every scheduler.interval seconds,
+    # and results the retry policy rejects are queued again once their backoff has passed
+    items = iter(items)
+    pending, attempts = {}, {}
+    retries, n_retries = [], itertools.count()
+
+    def submit(item, attempt):
+        future = executor.submit(f, item)
+        pending[future] = item
+        attempts[future] = attempt
+
+    while True:
+        status = scheduler.update(len(pending))
+        if status is not None and metrics is not None:
+            metrics.emit(
+                "workers", scheduler.limit,
+                running=len(pending), mem_available=status.mem_available, load=status.load, workers_rss=status.workers_rss,
+            )
+
+        now = time.monotonic()
+        n_free = max(scheduler.limit - len(pending), 0)
+        # retries that are due go before new items
+        while n_free and retries and retries[0][0] <= now:
+            _, _, item, attempt = heapq.heappop(retries)
+            submit(item, attempt)
+            n_free -= 1
+        for item in itertools.islice(items, n_free):
+            submit(item, 0)
+
+        if not pending and not retries:
+            break
+
+        timeout = scheduler.interval
+        if retries:
+            timeout = min(timeout or math.inf, max(retries[0][0] - now, 0.0))
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if metrics is not None:
+            metrics.emit("queue_depth", len(pending) - len(done))
+
+        for future in done:
+            item, attempt = pending.pop(future), attempts.pop(future)
+            result = future.result()
+            if retry_policy is not None and retry_policy.should_retry(result, attempt):
+                delay = retry_policy.get_delay(attempt)
+                print(f"RETRY {item} (attempt {attempt + 2}) in {delay:.0f}s")
+                if metrics is not None:
+                    metrics.emit("webin_retry", delay, attempt=attempt + 1,)
+                heapq.heappush(retries, (time.monotonic() + delay, next(n_retries), item, attempt + 1,))
+                continue
+            yield result
+
+
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+
+
+def upload(manifests, upload_f, threads=1, max_pending=None, executor="thread", metrics=None, scheduler=None, retry_policy=None,):
+    if scheduler is not None or retry_policy is not None:
+        scheduler = scheduler or FixedScheduler(threads, max_pending)
+        with EXECUTORS[executor](max_workers=scheduler.max_workers) as pool:
+            results = as_completed_scheduled(pool, upload_f, manifests, scheduler, retry_policy=retry_policy, metrics=metrics,)
+            for i, (ena_id, messages, manifest) in enumerate(results, start=1):
+                yield i, ena_id, messages, manifest
+    elif threads == 1:
         for i, manifest in enumerate(manifests, start=1,):
             ena_id, messages, manifest = upload_f(manifest)
             yield i, ena_id, messages, manifest
     else:
-        with Pool(processes=threads) as pool:
-            results = [pool.apply_async(upload_f, (manifest,)) for manifest in manifests]
-
-            for i, (ena_id, messages, manifest) in enumerate([res.get() for res in results], start=1):
+        max_pending = max_pending or 2 * threads
+        with EXECUTORS[executor](max_workers=threads) as pool:
+            results = as_completed_bounded(pool, upload_f, manifests, max_pending, metrics=metrics,)
+            for i, (ena_id, messages, manifest) in enumerate(results, start=1):
                 yield i, ena_id, messages, manifest
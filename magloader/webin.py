@@ -1,10 +1,24 @@
 # (magloader) magloader % ena-webin-cli -username Webin-68314 -password 'qvy!qdu9bgv5HVQ6xfq' -context genome -manifest manifest.txt -submit -test
+import atexit
+import collections
+import contextlib
+import os
 import pathlib
 import re
 import shlex
+import signal
 import subprocess
+import threading
+import time
+
+from dataclasses import dataclass, field
+from functools import partial
+
+from .resources import parse_memory
 
 LOGLINE_RE = re.compile(r'(^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}) ([A-Z]+ *): (.+)$')
+# webin-cli's console output has no timestamp (ERROR: Invalid field value. ...), a launcher may add one
+CONSOLE_LINE_RE = re.compile(r'^(?:[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2} )?(ERROR|WARN(?:ING)?|INFO|DEBUG) *: (.+)$')
 
 # (4, 'ERROR', 'In analysis, alias: "webin-genome-spire_assembly_46121". The object being added already exists in the submission account with accession: "ERZ27247457". The submission has failed because of a system error.')
 RECORD_EXISTS_RE = re.compile(
@@ -12,85 +26,394 @@ RECORD_EXISTS_RE = re.compile(
 	r'The object being added already exists in the submission account with accession: "(.+)"\. The submission has failed because of a system error.'
 )
 
+# errors that may go away on another attempt: ENA/FTP outages, timeouts, server-side system errors.
+# Only the start of a message counts (TRANSIENT_ERROR_RE.match), so that file names, contig names
+# or values quoted later in a validation error cannot make it look transient, e.g.
+# ERROR : The submission has failed because of a system error.
+# ERROR : Failed to upload files to webin file upload area: Connection reset
+# ERROR : Could not connect to FTP server webin2.ebi.ac.uk: Read timed out
+# ERROR : java.net.SocketTimeoutException: Read timed out
+# ERROR : Submission failed: HTTP/1.1 503 Service Unavailable
+# ERROR : Validation failed with status code 502.
+# but not:
+# ERROR : Invalid sequence character in line 502. [...]
+# ERROR : Invalid field value. [manifest file: ..., field: COVERAGE, value: 500]
+# ERROR : Invalid fasta header in line 3: timeout_contig
+# ERROR : File not found: /x/ftp server/a.fa.gz
+TRANSIENT_ERROR_RE = re.compile(
+	r'(?:[\w.]+(?:Exception|Error): )?(?:'
+	r'The submission has failed because of a system error\b'
+	r'|Failed to (?:upload|connect|submit)\b'
+	r'|Could not connect to\b'
+	r'|(?:Submission|Validation|Upload|Request) failed\b[^\[]*?(?:\bHTTP(?:/[0-9.]+)?\b[^0-9]{0,20}|\bstatus(?: code)?:? ?)50[0234]\b'
+	r'|(?:Read|Connect|Connection) timed out\b'
+	r'|Connection (?:reset|refused|closed|aborted)\b'
+	r'|(?:Service unavailable|Service temporarily unavailable|Internal server error|Bad gateway|Gateway time-?out|Too many requests)\b'
+	r')',
+	re.IGNORECASE,
+)
+
+# done: the analysis exists already, transient: worth another attempt, permanent: invalid input, do not retry
+OUTCOMES = ("done", "transient", "permanent",)
+
+# the command is shlex-split, so it can be replaced by any compatible launcher, e.g. a nailgun client
+# talking to a warm JVM or a `java -Xshare... -jar webin-cli.jar` call with a class data archive.
+# JVM options (-Xmx, --java_opts) go where the command has a {jvm_opts} token, e.g.
+# `java {jvm_opts} -jar webin-cli.jar`, or right after a single-word launcher like ena-webin-cli
+WEBIN_CLI = "ena-webin-cli"
+JVM_OPTS = "{jvm_opts}"
+PASSWORD_MASK = "********"
+
+OUT_OF_MEMORY = "java.lang.OutOfMemoryError"
+
+WEBIN_CLI_REPORT = "webin-cli.report"
+# partial report and output of runs killed by the watchdog, appended per attempt
+WEBIN_CLI_TIMEOUT_LOG = "webin-cli.timeout.log"
+# output lines kept per run for the timeout log
+OUTPUT_TAIL = 200
+
+# protocol of the persistent webin-cli server (java/WebinCliServer.java, fake_webin.py):
+# one request per line with tab-separated arguments, answered by the output and an exit line
+SERVER_EXIT_MARKER = "@@WEBIN-CLI-EXIT@@"
+SERVER_ARG_SEP = "\t"
+SERVER_SOURCE = pathlib.Path(__file__).parent / "java" / "WebinCliServer.java"
+
+
+def is_out_of_memory(messages):
+    return any(OUT_OF_MEMORY in message for _, _, message in messages)
+
+
+def classify_messages(messages):
+    # sorts the report of a failed webin-cli run into one of OUTCOMES
+    errors = [(event, message) for _, event, message in messages if event in ("ERROR", "NOREPORT", "JVMERROR", "TIMEOUT",)]
+    if any(RECORD_EXISTS_RE.match(message) for _, message in errors):
+        return "done"
+    if not errors or is_out_of_memory(messages):
+        # failed without an error (nothing to go on) or out of memory (the heap is not going to grow by itself)
+        return "permanent"
+    # a single invalid field fails the next attempt just the same
+    if all(event in ("NOREPORT", "TIMEOUT",) or TRANSIENT_ERROR_RE.match(message) for event, message in errors):
+        return "transient"
+    return "permanent"
+
+
+def read_report(report_dir=None,):
+    # 2025-06-06T12:55:57 INFO : Submission(s) validated successfully.
+    webin_cli_report = pathlib.Path(report_dir or ".") / WEBIN_CLI_REPORT
+    if webin_cli_report.is_file():
+        with open(webin_cli_report, "rt", encoding="UTF-8",) as report:
+            for i, line in enumerate(report, start=1):
+                yield parse_logline(i, line)
+    else:
+        yield -1, "NOREPORT", ""
+
+
+def get_accession(messages):
+    # accession of a successful (or already existing) analysis from a submission report
+    for _, event, msg in messages:
+        if event == "ERROR":
+            record_exists = RECORD_EXISTS_RE.match(msg)
+            if record_exists:
+                return record_exists.group(2)
+            # 2025-07-02T14:43:24 ERROR: Invalid field value. Non-negative float expected. [manifest file: /g/bork6/schudoma/projects/spire/upload/prod/studies/260/work/assemblies/spire_assembly_46745/spire_assembly_46745.manifest.txt, line number: 9, field: COVERAGE, value: -1.0]
+            break
+        if event == "INFO" and msg.startswith(
+            "The submission has been completed successfully. "
+            "The following analysis accession was assigned to the submission:"
+        ):
+            return msg.split(" ")[-1]
+    return None
+
+
 def get_webin_credentials(f):
     with open(f, "rt", encoding="UTF-8") as _in:
         return _in.read().strip().split(":")
 
 
+def parse_logline(i, line):
+    logitem = LOGLINE_RE.match(line)
+    if not logitem:
+        event, message = "UNKNOWN", line
+    else:
+        try:
+            event, message = logitem.group(2), logitem.group(3)
+        except IndexError:
+            event, message = "LOGERROR", line
+
+    return i, event.strip(), message.strip()
+
+
+def parse_console_line(i, line):
+    console_item = CONSOLE_LINE_RE.match(line)
+    if not console_item:
+        return i, "UNKNOWN", line.strip()
+    return i, console_item.group(1), console_item.group(2).strip()
+
+
+def terminate(proc, grace_period=10.0,):
+    # SIGTERM to the whole process group, SIGKILL if it does not go away
+    for sig in (signal.SIGTERM, signal.SIGKILL,):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(timeout=grace_period)
+        except subprocess.TimeoutExpired:
+            continue
+        return
+
+
+def get_launch_command(command, jvm_opts):
+    cmd = shlex.split(command)
+    if JVM_OPTS in cmd:
+        i = cmd.index(JVM_OPTS)
+        return cmd[:i] + jvm_opts + cmd[i + 1:]
+    if len(cmd) == 1 or not jvm_opts:
+        return cmd[:1] + jvm_opts + cmd[1:]
+    raise ValueError(f"Cannot place JVM options in `{command}`, mark their position with {JVM_OPTS}.")
+
+
+def quote_command(cmd):
+    # shlex.join needs python 3.8
+    return " ".join(map(shlex.quote, cmd))
+
+
+class WebinCliServer:
+    """A long-running webin-cli JVM (java/WebinCliServer.java) that handles one request at a time.
+
+    Each worker thread keeps its own server (get_server), which is reused for as long as its heap
+    is large enough; servers that died, hung or were aborted are replaced on the next request.
+    """
+    _local = threading.local()
+    _running = []
+    _lock = threading.Lock()
+
+    def __init__(self, command, heap=None, jvm_opts=None,):
+        self.command = command
+        self.heap = heap
+        cmd = get_launch_command(command, list(jvm_opts or ()) + ([f"-Xmx{heap}"] if heap else []))
+        print(f"Starting webin-cli server: `{quote_command(cmd)}`")
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True,)
+        self.returncode = None
+        with WebinCliServer._lock:
+            WebinCliServer._running.append(self)
+
+    @classmethod
+    def get_server(cls, command, heap=None, jvm_opts=None,):
+        server = getattr(cls._local, "server", None)
+        if server is not None and server.is_usable(command, heap):
+            return server
+        if server is not None:
+            server.stop()
+        server = cls._local.server = cls(command, heap=heap, jvm_opts=jvm_opts,)
+        return server
+
+    @classmethod
+    def stop_all(cls):
+        with cls._lock:
+            servers = list(cls._running)
+        for server in servers:
+            server.stop()
+
+    def is_usable(self, command, heap=None,):
+        if self.command != command or self.proc.poll() is not None:
+            return False
+        return heap is None or (self.heap is not None and parse_memory(self.heap) >= parse_memory(heap))
+
+    def request(self, args):
+        # yields the output lines of one webin-cli run, the exit code is in self.returncode
+        # (None if the server went away before finishing the run)
+        self.returncode = None
+        try:
+            self.proc.stdin.write((SERVER_ARG_SEP.join(args) + "\n").encode())
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            return
+        for line in self.proc.stdout:
+            if line.startswith(SERVER_EXIT_MARKER.encode()):
+                self.returncode = int(line.split()[1])
+                return
+            yield line
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            terminate(self.proc)
+        self.proc.stdout.close()
+        with WebinCliServer._lock:
+            if self in WebinCliServer._running:
+                WebinCliServer._running.remove(self)
+        if getattr(WebinCliServer._local, "server", None) is self:
+            WebinCliServer._local.server = None
+
+
+atexit.register(WebinCliServer.stop_all)
+
+
+@dataclass
+class WebinRun:
+    returncode: int = None
+    aborted: bool = False
+    timeout: float = None
+    timed_out: bool = False
+    # (i, event, message) of the ERROR/JVM error lines seen in the output
+    errors: list = field(default_factory=list)
+    tail: collections.deque = field(default_factory=lambda: collections.deque(maxlen=OUTPUT_TAIL))
+
+
 class EnaWebinClient:
-    def __init__(self, username, password):
+    def __init__(self, username, password, executable=WEBIN_CLI, abort_on_error=False, server=None, java_opts=None,):
         self.username = username
         self.password = password
+        self.executable = executable or WEBIN_CLI
+        # terminate the JVM on the first error that another attempt would not fix
+        self.abort_on_error = abort_on_error
+        # command starting a persistent webin-cli server, replaces one JVM per run
+        self.server = server
+        self.java_opts = shlex.split(java_opts or "")
 
-    def _run_client(self, manifest, validate=True, dev=True, java_max_heap=None,):
-        mode = "-validate" if validate else "-submit"
-        server = "-test" if dev else ""
-        jvm_heap = f"-Xmx{java_max_heap}" if java_max_heap else ""
-        cmd = f"ena-webin-cli {jvm_heap} -username {self.username} -password '{self.password}' -context genome -manifest {manifest} {mode} {server}"
-        print(f"CMD: `{cmd}`")
+    def get_jvm_opts(self, java_max_heap=None,):
+        return self.java_opts + ([f"-Xmx{java_max_heap}"] if java_max_heap else [])
 
+    def get_webin_args(self, manifest, validate=True, dev=True, password=None,):
+        args = ["-username", self.username, "-password", password or self.password, "-context", "genome", "-manifest", str(manifest),]
+        args.append("-validate" if validate else "-submit")
+        if dev:
+            args.append("-test")
+        return args
+
+    def get_command(self, manifest, validate=True, dev=True, java_max_heap=None, password=None,):
+        return (
+            get_launch_command(self.executable, self.get_jvm_opts(java_max_heap))
+            + self.get_webin_args(manifest, validate=validate, dev=dev, password=password,)
+        )
+
+    def _run_client(self, manifest, validate=True, dev=True, java_max_heap=None, cwd=None, timeout=None,):
+        # a report left behind by an earlier (aborted) run must not be mistaken for this run's
         try:
-            proc = subprocess.run(shlex.split(cmd), check=True, capture_output=True,)
-        except subprocess.CalledProcessError as err:
+            (pathlib.Path(cwd or ".") / WEBIN_CLI_REPORT).unlink()
+        except FileNotFoundError:
             pass
 
-        return proc
-
-    def _evaluate_report(self):
-        # 2025-06-06T12:55:57 INFO : Submission(s) validated successfully.
-        webin_cli_report = pathlib.Path("webin-cli.report")
-        if webin_cli_report.is_file():
-            with open(webin_cli_report.name, "rt", encoding="UTF-8",) as report:
-                for i, line in enumerate(report, start=1):
-                    logitem = LOGLINE_RE.match(line)
-                    if not logitem:
-                        event, message = "UNKNOWN", line
-                    else:
-                        try:
-                            event, message = logitem.group(2), logitem.group(3)
-                        except IndexError:
-                            event, message = "LOGERROR", line
-
-                    yield i, event.strip(), message.strip()
+        run = WebinRun(timeout=timeout)
+        if self.server:
+            self._run_on_server(run, manifest, validate=validate, dev=dev, java_max_heap=java_max_heap, cwd=cwd,)
         else:
-            yield -1, "NOREPORT", ""
+            self._run_process(run, manifest, validate=validate, dev=dev, java_max_heap=java_max_heap, cwd=cwd,)
+
+        if run.timed_out:
+            self._save_timeout_log(run, "validate" if validate else "submit", cwd=cwd,)
+
+        return run
 
-    def validate(self, manifest, dev=True, java_max_heap=None,):
+    def _run_process(self, run, manifest, validate=True, dev=True, java_max_heap=None, cwd=None,):
+        cmd = self.get_command(manifest, validate=validate, dev=dev, java_max_heap=java_max_heap,)
+        # the password never goes to the logs
+        print(f"CMD: `{quote_command(self.get_command(manifest, validate=validate, dev=dev, java_max_heap=java_max_heap, password=PASSWORD_MASK,))}`")
+
+        # output is consumed (and echoed) line by line while the JVM runs, only errors and a short tail are kept;
+        # the client runs in its own process group, so that terminating it also ends the JVM below a launcher script
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, start_new_session=True,) as proc:
+            with self._watchdog(proc, run, manifest):
+                self._read_output(proc.stdout, run, manifest, partial(terminate, proc),)
+            run.returncode = proc.wait()
+
+    def _run_on_server(self, run, manifest, validate=True, dev=True, java_max_heap=None, cwd=None,):
+        # the server's JVM does not change directory per run: the manifest's relative paths
+        # are resolved against -inputDir and the report goes to -outputDir
+        run_dir = str(pathlib.Path(cwd or ".").resolve())
+        manifest_path = str((pathlib.Path(run_dir) / manifest).resolve())
+        args = self.get_webin_args(manifest_path, validate=validate, dev=dev,) + ["-inputDir", run_dir, "-outputDir", run_dir,]
+        print(f"SERVER: `{quote_command(self.get_webin_args(manifest_path, validate=validate, dev=dev, password=PASSWORD_MASK,))}`")
+
+        server = WebinCliServer.get_server(self.server, heap=java_max_heap, jvm_opts=self.java_opts,)
+        with self._watchdog(server.proc, run, manifest):
+            self._read_output(server.request(args), run, manifest, partial(terminate, server.proc),)
+        run.returncode = server.returncode
+        if run.returncode is None:
+            # killed (watchdog, abort) or crashed (out of memory): the next request gets a fresh JVM
+            server.stop()
+            run.returncode = server.proc.returncode if server.proc.returncode is not None else 1
+
+    @contextlib.contextmanager
+    def _watchdog(self, proc, run, manifest):
+        # the watchdog kills a hung or stalled client (e.g. an FTP upload that does not progress),
+        # which also ends the output loop
+        watchdog = None
+        if run.timeout:
+            watchdog = threading.Timer(run.timeout, self._on_timeout, args=(proc, run, manifest,),)
+            watchdog.daemon = True
+            watchdog.start()
         try:
-            proc = self._run_client(manifest, validate=True, dev=dev, java_max_heap=java_max_heap,)
-        except subprocess.CalledProcessError as err:
-            print("CAUGHT CALLED_PROCESS_ERROR:\n", err)
-        else:
-            print("PROC", proc)
+            yield
         finally:
-            messages = list(self._evaluate_report())
-        
+            if watchdog is not None:
+                watchdog.cancel()
+
+    def _on_timeout(self, proc, run, manifest):
+        print(f"[{manifest}] webin-cli did not finish within {run.timeout:.0f}s, terminating.")
+        run.timed_out = True
+        terminate(proc)
+
+    def _save_timeout_log(self, run, mode, cwd=None,):
+        webin_cli_report = pathlib.Path(cwd or ".") / WEBIN_CLI_REPORT
+        with open(pathlib.Path(cwd or ".") / WEBIN_CLI_TIMEOUT_LOG, "at", encoding="UTF-8",) as _out:
+            print(f"### {time.strftime('%Y-%m-%dT%H:%M:%S')} {mode} killed after {run.timeout:.0f}s", file=_out,)
+            if webin_cli_report.is_file():
+                print(f"### {WEBIN_CLI_REPORT}", file=_out,)
+                with open(webin_cli_report, "rt", encoding="UTF-8",) as report:
+                    _out.write(report.read())
+            print(f"### output (last {OUTPUT_TAIL} lines)", *run.tail, sep="\n", file=_out,)
+
+    def _read_output(self, lines, run, manifest, kill):
+        for i, line in enumerate(lines, start=1):
+            line = line.decode(errors="replace").rstrip()
+            run.tail.append(line)
+            print(f"[{manifest}] {line}")
+            if OUT_OF_MEMORY in line:
+                run.errors.append((-1, "JVMERROR", line.strip(),))
+                continue
+            _, event, message = parse_console_line(i, line)
+            if event != "ERROR":
+                continue
+            run.errors.append((i, event, message,))
+            if self.abort_on_error and classify_messages([(i, event, message,)]) == "permanent":
+                print(f"[{manifest}] unrecoverable error, terminating webin-cli.")
+                run.aborted = True
+                kill()
+                break
+
+    def _evaluate_report(self, report_dir=None,):
+        yield from read_report(report_dir=report_dir)
+
+    def _get_messages(self, run, report_dir=None,):
+        # report first, then errors only seen in the output: the JVM's own errors,
+        # and the lines an aborted run did not get to write into the report
+        messages = list(self._evaluate_report(report_dir=report_dir))
+        seen = {message for _, _, message in messages}
+        messages += (item for item in run.errors if item[2] not in seen)
+        if run.aborted:
+            messages.append((-1, "ABORTED", "webin-cli was terminated after an unrecoverable error."))
+        if run.timed_out:
+            messages.append((-1, "TIMEOUT", f"webin-cli did not finish within {run.timeout:.0f}s, see {WEBIN_CLI_TIMEOUT_LOG}."))
+        return messages
+
+    def validate(self, manifest, dev=True, java_max_heap=None, cwd=None, timeout=None,):
+        run = self._run_client(manifest, validate=True, dev=dev, java_max_heap=java_max_heap, cwd=cwd, timeout=timeout,)
+        print("PROC", manifest, run.returncode, *(("ABORTED",) if run.aborted else ()), *(("TIMEOUT",) if run.timed_out else ()),)
+        messages = self._get_messages(run, report_dir=cwd)
+
         if len(messages) == 1 and messages[0][2] == "Submission(s) validated successfully.":
             return True, messages
 
         return False, messages
 
-    def submit(self, manifest, dev=True, java_max_heap=None,):
-        try:
-            proc = self._run_client(manifest, validate=False, dev=dev, java_max_heap=java_max_heap,)
-        except subprocess.CalledProcessError as err:
-            print("CAUGHT CALLED_PROCESS_ERROR:\n", err)
-        else:
-            print("PROC", proc)
-        finally:
-            messages = list(self._evaluate_report())
-        
-        for _, event, msg in messages:
-            if event == "ERROR":
-                record_exists = RECORD_EXISTS_RE.match(msg)
-                if record_exists:
-                    return record_exists.group(2), messages
-                # 2025-07-02T14:43:24 ERROR: Invalid field value. Non-negative float expected. [manifest file: /g/bork6/schudoma/projects/spire/upload/prod/studies/260/work/assemblies/spire_assembly_46745/spire_assembly_46745.manifest.txt, line number: 9, field: COVERAGE, value: -1.0]
-                break
-            if event == "INFO" and msg.startswith(
-                "The submission has been completed successfully. "
-                "The following analysis accession was assigned to the submission:"
-            ):
-                return msg.split(" ")[-1], messages
+    def submit(self, manifest, dev=True, java_max_heap=None, cwd=None, timeout=None,):
+        run = self._run_client(manifest, validate=False, dev=dev, java_max_heap=java_max_heap, cwd=cwd, timeout=timeout,)
+        print("PROC", manifest, run.returncode, *(("ABORTED",) if run.aborted else ()), *(("TIMEOUT",) if run.timed_out else ()),)
+        messages = self._get_messages(run, report_dir=cwd)
 
-        return None, messages
+        return get_accession(messages), messages
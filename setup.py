@@ -51,7 +51,7 @@ with open(path.join(here, "DESCRIPTION.md"), encoding="utf-8") as description:
 		zip_safe=False,
 		keywords="ena mag upload",
 		packages=find_packages(exclude=["test"]),
-		package_data={},
+		package_data={"magloader": ["java/*.java"]},
 		include_package_data=True,
 			entry_points={
 				"console_scripts": [